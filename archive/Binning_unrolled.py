@@ -0,0 +1,172 @@
+###########################################################################################
+# Hand unrolled binning routines
+###########################################################################################
+# Replaced by QDataCube.binKernel in helpers/Processing_helper.py
+# Kept for benchmarking, bins the first two axes of (m, n, o) arrays.
+###########################################################################################
+
+import numpy as np
+from   numba import jit, prange
+
+# Binning 2 pixels of the 8bit images
+@jit(nopython=True, fastmath=True, parallel=True, cache=True)
+def bin2(arr_in):
+    m,n,o   = np.shape(arr_in)
+    arr_tmp = np.empty((m//2,n,o), dtype='uint16')
+    arr_out = np.empty((m//2,n//2,o), dtype='uint16')
+    for i in prange(m//2):
+        arr_tmp[i,:,:] =  arr_in[i*2,:,:] +  arr_in[i*2+1,:,:]
+    for j in prange(n//2):
+        arr_out[:,j,:] = arr_tmp[:,j*2,:] + arr_tmp[:,j*2+1,:] 
+    return arr_out
+
+# Binning 3 pixels of the 8bit images
+@jit(nopython=True, fastmath=True, parallel=True, cache=True)
+def bin3(arr_in):
+    m,n,o   = np.shape(arr_in)
+    arr_tmp = np.empty((m//3,n,o), dtype='uint16')
+    arr_out = np.empty((m//3,n//3,o), dtype='uint16')
+    for i in prange(m//3):
+        arr_tmp[i,:,:] =  arr_in[i*3,:,:] +  arr_in[i*3+1,:,:] +  arr_in[i*3+2,:,:] 
+    for j in prange(n//3):
+        arr_out[:,j,:] = arr_tmp[:,j*3,:] + arr_tmp[:,j*3+1,:] + arr_tmp[:,j*3+2,:] 
+    return arr_out
+
+# Binning 4 pixels of the 8bit images
+@jit(nopython=True, fastmath=True, parallel=True, cache=True)
+def bin4(arr_in):
+    m,n,o   = np.shape(arr_in)
+    arr_tmp = np.empty((m//4,n,o), dtype='uint16')
+    arr_out = np.empty((m//4,n//4,o), dtype='uint16')
+    for i in prange(m//4):
+        arr_tmp[i,:,:] =  arr_in[i*4,:,:] +  arr_in[i*4+1,:,:] +  arr_in[i*4+2,:,:] +  arr_in[i*4+3,:,:]
+    for j in prange(n//4):
+        arr_out[:,j,:] = arr_tmp[:,j*4,:] + arr_tmp[:,j*4+1,:] + arr_tmp[:,j*4+2,:] + arr_tmp[:,j*4+3,:]
+    return arr_out
+
+# Binning 5 pixels of the 8bit images
+@jit(nopython=True, fastmath=True, parallel=True, cache=True)
+def bin5(arr_in):
+    m,n,o   = np.shape(arr_in)
+    arr_tmp = np.empty((m//5,n,o), dtype='uint16')
+    arr_out = np.empty((m//5,n//5,o), dtype='uint16')
+    for i in prange(m//5):
+        arr_tmp[i,:,:] =  arr_in[i*5,:,:] +  arr_in[i*5+1,:,:] +  arr_in[i*5+2,:,:] +  arr_in[i*5+3,:,:] +  arr_in[i*5+4,:,:]
+    for j in prange(n//5):
+        arr_out[:,j,:] = arr_tmp[:,j*5,:] + arr_tmp[:,j*5+1,:] + arr_tmp[:,j*5+2,:] + arr_tmp[:,j*5+3,:] + arr_tmp[:,j*5+4,:] 
+    return arr_out
+
+# Binning 6 pixels of the 8bit images
+@jit(nopython=True, fastmath=True, parallel=True, cache=True)
+def bin6(arr_in):
+    m,n,o   = np.shape(arr_in)
+    arr_tmp = np.empty((m//6,n,o), dtype='uint16')
+    arr_out = np.empty((m//6,n//6,o), dtype='uint16')
+    for i in prange(m//6):
+        arr_tmp[i,:,:] =  arr_in[i*6,:,:] +  arr_in[i*6+1,:,:] +  arr_in[i*6+2,:,:] +  arr_in[i*6+3,:,:] +  arr_in[i*6+4,:,:]  \
+                       +  arr_in[i*6+5,:,:]
+    for j in prange(n//6):
+        arr_out[:,j,:] = arr_tmp[:,j*6,:] + arr_tmp[:,j*6+1,:] + arr_tmp[:,j*6+2,:] + arr_tmp[:,j*6+3,:] + arr_tmp[:,j*6+4,:] \
+                       + arr_tmp[:,j*6+5,:]  
+    return arr_out
+
+# Binning 9 pixels of the 8bit images
+@jit(nopython=True, fastmath=True, parallel=True, cache=True)
+def bin9(arr_in):
+    m,n,o   = np.shape(arr_in)
+    arr_tmp = np.empty((m//9,n,o), dtype='uint16')
+    arr_out = np.empty((m//9,n//9,o), dtype='uint16')
+    for i in prange(m//9):
+        arr_tmp[i,:,:] =  arr_in[i*9,:,:]   + arr_in[i*9+1,:,:]  + arr_in[i*9+2,:,:]  + arr_in[i*9+3,:,:]  +  arr_in[i*9+4,:,:] \
+                       +  arr_in[i*9+5,:,:] + arr_in[i*9+6,:,:]  + arr_in[i*9+7,:,:]  + arr_in[i*9+8,:,:] 
+    for j in prange(n//9):
+        arr_out[:,j,:] = arr_tmp[:,j*9,:]   + arr_tmp[:,j*9+1,:] + arr_tmp[:,j*9+2,:] + arr_tmp[:,j*9+3,:] + arr_tmp[:,j*9+4,:] \
+                       + arr_tmp[:,j*9+5,:] + arr_tmp[:,j*9+6,:] + arr_tmp[:,j*9+7,:] + arr_tmp[:,j*9+8,:]
+    return arr_out
+
+# Binning 10 pixels of the 8bit images
+@jit(nopython=True, fastmath=True, parallel=True, cache=True)
+def bin10(arr_in):
+    m,n,o   = np.shape(arr_in)
+    arr_tmp = np.empty((m//10,n,o), dtype='uint16')
+    arr_out = np.empty((m//10,n//10,o), dtype='uint16')
+    for i in prange(m//10):
+        arr_tmp[i,:,:] =  arr_in[i*10,:,:]   + arr_in[i*10+1,:,:] +  arr_in[i*10+2,:,:] +  arr_in[i*10+3,:,:] +  arr_in[i*10+4,:,:] \
+                        + arr_in[i*10+5,:,:] + arr_in[i*10+6,:,:] +  arr_in[i*10+7,:,:] +  arr_in[i*10+8,:,:] +  arr_in[i*10+9,:,:]
+
+    for j in prange(n//10):
+        arr_out[:,j,:] = arr_tmp[:,j*10,:]   + arr_tmp[:,j*10+1,:] + arr_tmp[:,j*10+2,:] + arr_tmp[:,j*10+3,:] + arr_tmp[:,j*10+4,:] \
+                       + arr_tmp[:,j*10+5,:] + arr_tmp[:,j*10+6,:] + arr_tmp[:,j*10+7,:] + arr_tmp[:,j*10+8,:] + arr_tmp[:,j*10+9,:]
+    return arr_out
+
+# Binning 12 pixels of the 8bit images
+@jit(nopython=True, fastmath=True, parallel=True, cache=True)
+def bin12(arr_in):
+    m,n,o   = np.shape(arr_in)
+    arr_tmp = np.empty((m//12,n,o), dtype='uint16')
+    arr_out = np.empty((m//12,n//12,o), dtype='uint32')
+    for i in prange(m//12):
+        arr_tmp[i,:,:] =  arr_in[i*12,:,:]    + arr_in[i*12+1,:,:]  + arr_in[i*12+2,:,:]  + arr_in[i*12+3,:,:]  + arr_in[i*12+4,:,:]  \
+                        + arr_in[i*12+5,:,:]  + arr_in[i*12+6,:,:]  + arr_in[i*12+7,:,:]  + arr_in[i*12+8,:,:]  + arr_in[i*12+9,:,:]  \
+                        + arr_in[i*12+10,:,:] + arr_in[i*12+11,:,:] 
+
+    for j in prange(n//12):
+        arr_out[:,j,:]  = arr_tmp[:,j*12,:]    + arr_tmp[:,j*12+1,:]  + arr_tmp[:,j*12+2,:] + arr_tmp[:,j*12+3,:] + arr_tmp[:,j*12+4,:] \
+                        + arr_tmp[:,j*12+5,:]  + arr_tmp[:,j*12+6,:]  + arr_tmp[:,j*12+7,:] + arr_tmp[:,j*12+8,:] + arr_tmp[:,j*12+9,:] \
+                        + arr_tmp[:,j*12+10,:] + arr_tmp[:,j*12+11,:] 
+    return arr_out
+
+# Binning 15 pixels of the 8bit images
+@jit(nopython=True, fastmath=True, parallel=True, cache=True)
+def bin15(arr_in):
+    m,n,o   = np.shape(arr_in)
+    arr_tmp = np.empty((m//15,n,o), dtype='uint16')
+    arr_out = np.empty((m//15,n//15,o), dtype='uint32')
+    for i in prange(m//15):
+        arr_tmp[i,:,:] =  arr_in[i*15,:,:]    + arr_in[i*15+1,:,:]  + arr_in[i*15+2,:,:]  + arr_in[i*15+3,:,:]  + arr_in[i*15+4,:,:]  \
+                        + arr_in[i*15+5,:,:]  + arr_in[i*15+6,:,:]  + arr_in[i*15+7,:,:]  + arr_in[i*15+8,:,:]  + arr_in[i*15+9,:,:]  \
+                        + arr_in[i*15+10,:,:] + arr_in[i*15+11,:,:] + arr_in[i*15+12,:,:] + arr_in[i*15+13,:,:] + arr_in[i*15+14,:,:] 
+
+    for j in prange(n//15):
+        arr_out[:,j,:]  = arr_tmp[:,j*15,:]    + arr_tmp[:,j*15+1,:]  + arr_tmp[:,j*15+2,:]  + arr_tmp[:,j*15+3,:]  + arr_tmp[:,j*15+4,:]  \
+                        + arr_tmp[:,j*15+5,:]  + arr_tmp[:,j*15+6,:]  + arr_tmp[:,j*15+7,:]  + arr_tmp[:,j*15+8,:]  + arr_tmp[:,j*15+9,:]  \
+                        + arr_tmp[:,j*15+10,:] + arr_tmp[:,j*15+11,:] + arr_tmp[:,j*15+12,:] + arr_tmp[:,j*15+13,:] + arr_tmp[:,j*15+14,:]
+    return arr_out
+
+# Binning 18 pixels of the 8bit images
+@jit(nopython=True, fastmath=True, parallel=True, cache=True)
+def bin18(arr_in):
+    m,n,o   = np.shape(arr_in)
+    arr_tmp = np.empty((m//18,n,o), dtype='uint16')
+    arr_out = np.empty((m//18,n//18,o), dtype='uint32')
+    for i in prange(m//18):
+        arr_tmp[i,:,:] =  arr_in[i*18,:,:]    + arr_in[i*18+1,:,:]  + arr_in[i*18+2,:,:]  + arr_in[i*18+3,:,:]  + arr_in[i*18+4,:,:]  \
+                        + arr_in[i*18+5,:,:]  + arr_in[i*18+6,:,:]  + arr_in[i*18+7,:,:]  + arr_in[i*18+8,:,:]  + arr_in[i*18+9,:,:]  \
+                        + arr_in[i*18+10,:,:] + arr_in[i*18+11,:,:] + arr_in[i*18+12,:,:] + arr_in[i*18+13,:,:] + arr_in[i*18+14,:,:] \
+                        + arr_in[i*18+15,:,:] + arr_in[i*18+16,:,:] + arr_in[i*18+17,:,:] 
+
+    for j in prange(n//18):
+        arr_out[:,j,:]  = arr_tmp[:,j*18,:]    + arr_tmp[:,j*18+1,:]  + arr_tmp[:,j*18+2,:]  + arr_tmp[:,j*18+3,:]  + arr_tmp[:,j*18+4,:]  \
+                        + arr_tmp[:,j*18+5,:]  + arr_tmp[:,j*18+6,:]  + arr_tmp[:,j*18+7,:]  + arr_tmp[:,j*18+8,:]  + arr_tmp[:,j*18+9,:]  \
+                        + arr_tmp[:,j*18+10,:] + arr_tmp[:,j*18+11,:] + arr_tmp[:,j*18+12,:] + arr_tmp[:,j*18+13,:] + arr_tmp[:,j*18+14,:] \
+                        + arr_tmp[:,j*18+15,:] + arr_tmp[:,j*18+16,:] + arr_tmp[:,j*18+17,:]  
+    return arr_out
+
+# Binning 20 pixels of the 8bit images
+@jit(nopython=True, fastmath=True, parallel=True, cache=True)
+def bin20(arr_in):
+    m,n,o   = np.shape(arr_in)
+    arr_tmp = np.empty((m//20,n,o), dtype='uint16')
+    arr_out = np.empty((m//20,n//20,o), dtype='uint32')
+    for i in prange(m//20):
+        arr_tmp[i,:,:] =  arr_in[i*20,:,:]  + arr_in[i*20+1,:,:]  + arr_in[i*20+2,:,:]  + arr_in[i*20+3,:,:]  + arr_in[i*20+4,:,:]  + arr_in[i*20+5,:,:]  + \
+                        arr_in[i*20+6,:,:]  + arr_in[i*20+7,:,:]  + arr_in[i*20+8,:,:]  + arr_in[i*20+9,:,:]  + arr_in[i*20+10,:,:] + arr_in[i*20+11,:,:] + \
+                        arr_in[i*20+12,:,:] + arr_in[i*20+13,:,:] + arr_in[i*20+14,:,:] + arr_in[i*20+15,:,:] + arr_in[i*20+16,:,:] + arr_in[i*20+17,:,:] + \
+                        arr_in[i*20+18,:,:] + arr_in[i*20+19,:,:]
+
+    for j in prange(n//20):
+        arr_out[:,j,:]  = arr_tmp[:,j*20,:]  + arr_tmp[:,j*20+1,:]  + arr_tmp[:,j*20+2,:]  + arr_tmp[:,j*20+3,:]  + arr_tmp[:,j*10+4,:]  + arr_tmp[:,j*20+5,:]  + \
+                        arr_tmp[:,j*20+6,:]  + arr_tmp[:,j*20+7,:]  + arr_tmp[:,j*20+8,:]  + arr_tmp[:,j*20+9,:]  + arr_tmp[:,j*20+10,:] + arr_tmp[:,j*20+11,:] + \
+                        arr_tmp[:,j*20+12,:] + arr_tmp[:,j*20+13,:] + arr_tmp[:,j*10+14,:] + arr_tmp[:,j*20+15,:] + arr_tmp[:,j*20+16,:] + arr_tmp[:,j*20+17,:] + \
+                        arr_tmp[:,j*20+18,:] + arr_tmp[:,j*20+19,:] 
+    return arr_out
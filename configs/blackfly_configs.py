@@ -16,6 +16,13 @@ configs = {
                                         # line 2 has not isolation and takes 4-10us for a transition
     'ttlinv'          : True,           # inverted logic levels are best
     'trigin'          : -1,             # -1 use software, otherwise hardware
+    'streambuffers'   : -1,             # driver frame buffers, -1 = enough for two data cubes
+    ##############################################
+    # Data Cube
+    ##############################################
+    'cubeslots'       : 6,              # number of preallocated data cubes in ring buffer, 
+                                        # needs processing queue size + 3 (filling, processing and one spare)
+    'cubeshared'      : False,          # ring buffer in shared memory, needed for processing with worker processes
     ##############################################
     # Target Display
     ##############################################
@@ -28,5 +35,9 @@ configs = {
                                         # 5=upright diagonal flip 
                                         # 6=vertical 
                                         # 7=uperleft diagonal flip
-    'displayfps'       : 50             # frame rate for display, usually we skip frames for display but record at full camera fps
+    'displayfps'       : 50,            # frame rate for display, usually we skip frames for display but record at full camera fps
+    'colorgain'        : [1., 1., 1.],  # red, green, blue gain of pseudo color display
+    'coloroffset'      : [0., 0., 0.],  # red, green, blue offset of pseudo color display
+    'colorgamma'       : 1.0,           # gamma of pseudo color display
+    'temporalfilter'   : 0              # 0 three band equalizer, 1 highpass, 2 running sum highpass, cut off at low frequency
     }
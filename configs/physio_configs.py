@@ -0,0 +1,11 @@
+configs = {
+    ##############################################
+    # Physio
+    ##############################################
+    'fs'              : 30.,            # initial cube rate [Hz], measured rate is tracked
+    'window'          : 30.,            # sliding DFT window [s], frequency resolution is 1/window
+    'heart'           : (0.7, 3.5),     # heart rate band [Hz], 42..210 per minute
+    'respiration'     : (0.1, 0.5),     # respiration band [Hz], 6..30 per minute
+    'binning'         : 8,              # pulse map binning, in addition to camera binning
+    'channel'         : 0,              # LED channel 1..13 for physio, 0 = first measured channel
+    }
@@ -0,0 +1,18 @@
+configs = {
+    ##############################################
+    # Spectral Unmixing
+    ##############################################
+    'wavelengths'     : [],             # center wavelength [nm] of LED channel 1..13, needs to match light source
+    'spectra'         : {               # csv files with wavelength [nm], extinction
+        'HbO2'        : 'configs/spectra/hbo2.csv',
+        'Hb'          : 'configs/spectra/hb.csv',
+        'Melanin'     : 'configs/spectra/melanin.csv',
+        'Bilirubin'   : 'configs/spectra/bilirubin.csv',
+        'Fat'         : 'configs/spectra/fat.csv',
+        'Water'       : 'configs/spectra/water.csv',
+        },
+    'mie_power'       : 1.0,            # Mie scattering lambda^-mie_power
+    'reference'       : 65280,          # corrected value of 100% reflectance (255 x 256 for 8bit camera)
+    'mode'            : 0,              # 0 least squares, 1 non negative least squares
+    'iterations'      : 3,              # NNLS sweeps per cube, warm started from previous cube
+    }
@@ -12,6 +12,8 @@ from   PyQt5.QtWidgets import QLineEdit, QSlider, QCheckBox, QLabel
 import logging, time
 # Numerical Tools
 import numpy as np
+# Processing
+from   helpers.Processing_helper import QDataCube
 
 class BlackflyCapture(QObject):
     imageDataReady    = pyqtSignal(float, np.ndarray)                                     # image received on serial port
@@ -37,6 +39,9 @@ class BlackflyCapture(QObject):
         self._trigout        = configs['trigout']            # -1 no trigout, 1 = line 1 ..
         self._ttlinv         = configs['ttlinv']             # False = normal, True=inverted
         self._trigin         = configs['trigin']             # -1 no trigin,  1 = line 1 ..
+        self._cubeslots      = configs['cubeslots']          # number of data cubes in ring buffer
+        self._cubeshared     = configs['cubeshared']         # ring buffer in shared memory for process pool
+        self._streambuffers  = configs['streambuffers']      # number of driver frame buffers, -1 = two data cubes
 
         # Init vars
         self.frame_time   = 0.0
@@ -57,10 +62,14 @@ class BlackflyCapture(QObject):
                 image_result = self.camera.GetNextImage(1000) # timeout in ms, function blocks until timeout
                 if not image_result.IsIncomplete(): # should always be complete
                     # self.frame_time = self.camera.EventExposureEndTimestamp.GetValue()
-                    img = image_result.GetNDArray() # get inmage as NumPy array
-                    try: image_result.Release() # make next frame available, can create error during debug
-                    except: self.logger.log(logging.WARNING, "[CAM]: Can not release image!")
-                    self.datacube.add(img)
+                    # GetNDArray is a view of the driver buffer, 
+                    # it is copied once straight into the data cube slot, 
+                    # buffer can only be released afterwards
+                    self.datacube.add(image_result.GetNDArray())
+                else:
+                    self.datacube.skip()                      # sequence shifted, background location is unknown
+                try: image_result.Release() # make driver buffer available for next frame, can create error during debug
+                except: self.logger.log(logging.WARNING, "[CAM]: Can not release image!")
 
             # FPS calculation
             self.measured_fps = (0.9 * self.measured_fps) + (0.1/(current_time - last_time)) # low pass filter
@@ -238,7 +247,19 @@ class BlackflyCapture(QObject):
         except: pass
 
     def startAcquisition(self, depth=1, flatfield=None):
-        self.datacube = QDataCube(width=self.camera.width, height=self.camera.height, depth=depth, flatfield=flatfield)
+        # data cube matches pixel format so that driver buffer is copied without conversion
+        # bits is the significant bit depth of the data, it sets flatfield shift, display and color scaling
+        pixelformat = str(self.pixelformat)
+        if   pixelformat == 'Mono8':          (dtype, bits) = ('uint8',   8)
+        elif pixelformat.startswith('Mono10'): (dtype, bits) = ('uint16', 10)
+        elif pixelformat.startswith('Mono12'): (dtype, bits) = ('uint16', 12)
+        else:                                  (dtype, bits) = ('uint16', self.adc if self.adc in (10, 12, 14) else 16)
+        self.datacube = QDataCube(width=self.width, height=self.height, depth=depth, flatfield=flatfield, slots=self._cubeslots, 
+                                  dtype=dtype, bits=bits, shared=self._cubeshared)
+        self.logger.log(logging.INFO, "[PySpin]: Data cube {} with {} bits.".format(pixelformat, bits))
+        # driver needs to hold frames while capture thread completes a cube
+        if self._streambuffers == -1: self.streambuffers = 2*depth
+        else:                         self.streambuffers = self._streambuffers
         self.camera.BeginAcquisition() # Start Acquisition
         # if trigger source is Software: execute, otherwise nothing goes
         self.camera.TriggerSource.SetValue(PySpin.TriggerSource_Software)
@@ -254,6 +275,7 @@ class BlackflyCapture(QObject):
     def stopAcquisition(self):
         self.stopped = True
         self.camera.EndAcquisition()
+        self.datacube.close()
         del self.datacube
         self.logger.log(logging.INFO, "[PySpin]: Stopped acquiring images.")
     
@@ -657,6 +679,34 @@ class BlackflyCapture(QObject):
             return 'None'
         else: return -1
 
+    @property
+    def streambuffers(self):
+        """returns number of driver stream buffers """
+        if self.camera_open:
+            return self.camera.TLStream.StreamBufferCountResult.GetValue()
+        else: return -1
+    @streambuffers.setter
+    def streambuffers(self, val):
+        """sets number of driver stream buffers, frames are delivered oldest first """
+        if (val is None) or (val < 1):
+            self.logger.log(logging.ERROR, "[PySpin]: Camera:Can not set stream buffers to:{}!".format(val))
+            return
+        if self.camera_open:
+            if self.camera.TLStream.StreamBufferHandlingMode.GetAccessMode() == PySpin.RW:
+                self.camera.TLStream.StreamBufferHandlingMode.SetValue(PySpin.StreamBufferHandlingMode_OldestFirst)
+            else:
+                self.logger.log(logging.WARNING, "[PySpin]: Camera:StreamBufferHandlingMode: no access.")
+            if self.camera.TLStream.StreamBufferCountMode.GetAccessMode() == PySpin.RW:
+                self.camera.TLStream.StreamBufferCountMode.SetValue(PySpin.StreamBufferCountMode_Manual)
+            if self.camera.TLStream.StreamBufferCountManual.GetAccessMode() == PySpin.RW:
+                val = max(self.camera.TLStream.StreamBufferCountManual.GetMin(), min(self.camera.TLStream.StreamBufferCountManual.GetMax(), int(val)))
+                self.camera.TLStream.StreamBufferCountManual.SetValue(val)
+                self.logger.log(logging.INFO, "[PySpin]: Camera:StreamBuffers:{}.".format(val))
+            else:
+                self.logger.log(logging.ERROR, "[PySpin]: Camera:Failed to set stream buffers to:{}!".format(val))
+        else: # camera not open
+            self.logger.log(logging.ERROR, "[PySpin]: Camera:Failed to set stream buffers, camera not open!")
+
     @property
     def ttlinv(self):
         """returns tigger output ttl polarity """
@@ -11,6 +11,8 @@ from   PyQt5.QtWidgets import QLineEdit, QSlider, QCheckBox, QLabel
 import logging, time
 # Numerical Tools
 import numpy as np
+# Processing
+from   helpers.Processing_helper import QDataCube
 
 class OpenCVCapture(QObject):
 
@@ -54,6 +56,10 @@ class OpenCVCapture(QObject):
         else:                           self._autowb       = -1
         if 'settings' in configs:       self._settings     = configs['settings']
         else:                           self._settings     = -1
+        if 'cubeslots' in configs:      self._cubeslots    = configs['cubeslots']          # number of data cubes in ring buffer
+        else:                           self._cubeslots    = 5                             # processing queue maxsize 2 + 3
+        if 'cubeshared' in configs:     self._cubeshared   = configs['cubeshared']         # ring buffer in shared memory for process pool
+        else:                           self._cubeshared   = False
         
         # Init vars
         self.frame_time   = 0.0
@@ -80,6 +86,7 @@ class OpenCVCapture(QObject):
                 if (img is not None):
                     self.datacube.add(img)
                 else:
+                    self.datacube.skip()
                     self.logger.log(logging.WARNING, "[CAM]:no image available!")
 
             # FPS calculation
@@ -143,12 +150,13 @@ class OpenCVCapture(QObject):
 
     def startAcquisition(self, depth=1, flatfield=None):
         # create datacube structure
-        self.datacube = QDataCube(width=self.camera.width, height=self.camera.height, depth=depth, flatfield=flatfield)
+        self.datacube = QDataCube(width=self.width, height=self.height, depth=depth, flatfield=flatfield, slots=self._cubeslots, shared=self._cubeshared)
         self.stopped = False
         self.logger.log(logging.INFO, "[OpenCV]: Acquiring images.")
     
     def stopAcquisition(self):
         self.stopped = True
+        self.datacube.close()
         del self.datacube
         self.logger.log(logging.INFO, "[OpenCV]: Stopped acquiring images.")
 
@@ -0,0 +1,224 @@
+############################################################################################
+# Physio Helper
+############################################################################################
+# Remote photoplethysmography, heart and respiration rate from multispectral data cube
+# ------------------------------------------------------------------------------------------
+# Urs Utzinger
+# University of Arizona 2023
+############################################################################################
+
+############################################################################################
+# Band pass
+# ------------------------------------------------------------------------------------------
+# Difference of two poor man's lowpass filters y = (1-alpha) * y + alpha * x
+# with cut off at upper and lower band edge, alpha from poormansHighpassProcessor.computeAlpha
+#
+# Sliding DFT
+# ------------------------------------------------------------------------------------------
+# Only bins within heart or respiration band of an N sample window are kept,
+# each new sample updates them with one complex multiply-add per bin
+# X_k(n) = r e^(j 2pi k/N) [ X_k(n-1) + x(n) - r^N x(n-N) ]
+# r < 1 keeps the recursion stable.
+# https://www.dsprelated.com/showarticle/776.php
+#
+# Pulse amplitude map
+# ------------------------------------------------------------------------------------------
+# Each pixel of the binned channel is band passed to the heart band,
+# pulse amplitude is sqrt(lowpass(bandpass^2)) / DC  (perfusion index)
+# Lowpass filters are poormansHighpassProcessor.highpassKernel, band pass is the
+# difference of the highpass outputs at lower and upper band edge.
+#
+# Sampling
+# ------------------------------------------------------------------------------------------
+# Samples are time stamped when the cube was completed. Cubes dropped before
+# processing leave a gap, the last sample is held for the missing samples so that
+# the sliding DFT sees uniform sampling.
+############################################################################################
+
+import logging
+import math
+import numpy as np
+import cv2
+
+from helpers.Processing_helper import QDataCube, poormansHighpassProcessor
+
+class slidingDFT():
+    """
+    Sliding DFT
+    series independent time series, N samples window, bins k0..k1
+    """
+
+    def __init__(self, series: int, N: int, k0: int, k1: int, r: float = 0.9999):
+
+        self.N       = N
+        self.k       = np.arange(k0, k1+1)
+        self.twiddle = r * np.exp(2j*math.pi*self.k/N)                            # bins
+        self.rN      = r**N
+        self.delay   = np.zeros((N, series), 'float64')                            # delay line, x(n-N)
+        self.head    = 0
+        self.X       = np.zeros((series, len(self.k)), 'complex128')
+        self.count   = 0                                                           # samples in delay line
+
+    def update(self, x):
+        """ Add one sample of each series """
+        old = self.delay[self.head]
+        self.X += (x - self.rN*old)[:,None]
+        self.X *= self.twiddle
+        self.delay[self.head] = x
+        self.head  = (self.head + 1) % self.N
+        self.count = min(self.count + 1, self.N)
+
+    def peak(self):
+        """ Frequency of largest bin of each series in units of bins, parabolic interpolation """
+        power = np.abs(self.X)**2
+        i = np.argmax(power, axis=1)
+        k = self.k[i].astype('float64')
+        inside = (i > 0) & (i < len(self.k)-1)
+        rows = np.nonzero(inside)[0]
+        (a, b, c) = (power[rows, i[rows]-1], power[rows, i[rows]], power[rows, i[rows]+1])
+        d = a - 2.*b + c
+        k[rows] += np.where(d != 0., 0.5*(a - c)/np.where(d != 0., d, 1.), 0.)
+        return k
+
+class physioProcessor():
+    """
+    Physio
+    Heart and respiration rate of roi time series and pulse amplitude map.
+    channel is the LED channel (1..13) used, 0 uses the first measured channel.
+    Pulse map is computed on the channel binned by binning x binning.
+
+      reset     new sampling rate or number of rois
+      update    add roi means of one cube
+      rates     heart and respiration rate per minute of each roi
+      pulseMap  update and return pulse amplitude map
+      toImage   pulse map auto scaled to 8 bit display image
+    """
+
+    def __init__(self, fs: float = 30., window: float = 30., heart: tuple = (0.7, 3.5), respiration: tuple = (0.1, 0.5),
+                 binning: int = 8, channel: int = 0):
+
+        self.logger = logging.getLogger("Physio_")
+
+        self.fs          = fs                                                       # cubes per second
+        self.window      = window                                                   # seconds of sliding DFT
+        self.heart       = heart                                                    # Hz
+        self.respiration = respiration                                              # Hz
+        self.binning     = binning                                                  # pulse map binning
+        self.channel     = channel                                                  # LED channel
+        self.enabled     = False
+
+        self.series      = 0                                                        # number of rois
+        self.bands       = {}                                                       # band: filter state and sliding DFT
+        self.binned      = None                                                     # binned channel
+        self.fast        = None                                                     # pulse map, upper band edge lowpass
+        self.slow        = None                                                     # pulse map, lower band edge lowpass
+        self.power       = None                                                     # pulse map, lowpassed bandpass^2
+        self.hp_fast     = None                                                     # pulse map, highpass at upper band edge
+        self.hp_slow     = None                                                     # pulse map, highpass at lower band edge, bandpass^2
+        self.map         = None                                                     # pulse amplitude
+        self.image       = None                                                     # 8 bit pulse map
+        self._last_time  = None
+        self._last_x     = None                                                     # last roi means, held for missing samples
+
+    @staticmethod
+    def _alpha(fs, fc):
+        return min(poormansHighpassProcessor.computeAlpha(fs, fc), 1.)
+
+    def reset(self, fs: float, series: int):
+        """ Filters and sliding DFT for sampling rate fs and series time series """
+        self.fs     = fs
+        self.series = series
+        N = max(int(self.window*fs), 4)
+        self.bands = {}
+        for (name, (f_lo, f_hi)) in (('heart', self.heart), ('respiration', self.respiration)):
+            k0 = max(int(math.floor(f_lo*N/fs)), 1)
+            k1 = min(int(math.ceil(f_hi*N/fs)), N//2)
+            self.bands[name] = {
+                'a_hi'  : self._alpha(fs, f_hi),
+                'a_lo'  : self._alpha(fs, f_lo),
+                'fast'  : None,                                                     # initialized with first sample
+                'slow'  : None,
+                'sdft'  : slidingDFT(series, N, k0, max(k0, k1)) }
+        self.fast = None                                                            # pulse map restarts
+        self.logger.log(logging.INFO, "Status:Physio at {:.1f} Hz with {} samples window.".format(fs, N))
+
+    def update(self, means, timestamp: float):
+        """
+        Band pass roi means of one cube and add them to sliding DFT
+        timestamp is capture time of cube, sampling rate is tracked, missing samples hold the last sample
+        """
+        steps = 1
+        if self._last_time is not None and timestamp > self._last_time:
+            dt = timestamp - self._last_time
+            steps = max(int(round(dt*self.fs)), 1)                                  # > 1 if cubes were dropped
+            self.fs = 0.95*self.fs + 0.05*steps/dt
+        self._last_time = timestamp
+        if not self.bands or len(means) != self.series or abs(self.fs - self.bands['heart']['sdft'].N/self.window) > 0.1*self.fs:
+            self.reset(self.fs, len(means))
+            steps = 1
+        x = np.asarray(means, 'float64')
+        if self._last_x is not None and len(self._last_x) == len(x):
+            for i in range(min(steps, self.bands['heart']['sdft'].N) - 1):
+                self._bandpass(self._last_x)
+        self._bandpass(x)
+        self._last_x = x
+
+    def _bandpass(self, x):
+        for band in self.bands.values():
+            if band['fast'] is None:
+                band['fast'] = x.copy()
+                band['slow'] = x.copy()
+            band['fast'] += band['a_hi'] * (x - band['fast'])
+            band['slow'] += band['a_lo'] * (x - band['slow'])
+            band['sdft'].update(band['fast'] - band['slow'])
+
+    def rates(self):
+        """ series x (heart, respiration) per minute, NaN until window is filled """
+        rates = np.full((self.series, 2), np.nan, 'float32')
+        for j, name in enumerate(('heart', 'respiration')):
+            if name not in self.bands: continue
+            sdft = self.bands[name]['sdft']
+            if sdft.count < sdft.N: continue
+            rates[:,j] = 60. * sdft.peak() * self.fs / sdft.N
+        return rates
+
+    def pulseMap(self, image):
+        """ Bin channel image, update per pixel filters and return pulse amplitude map """
+        b = self.binning
+        (height, width) = image.shape
+        shape = (1, height//b, width//b)
+        dtype = QDataCube.binDtype(8*image.dtype.itemsize, b, b)
+        if self.binned is None or self.binned.shape != shape or self.binned.dtype != dtype:
+            self.binned = np.zeros(shape, dtype)
+            self.fast   = None
+        QDataCube.binKernel(image.reshape((1,)+image.shape), b, b, self.binned)
+        if self.fast is None:
+            self.fast    = self.binned[0].astype('float32')
+            self.slow    = self.binned[0].astype('float32')
+            self.power   = np.zeros(shape[1:], 'float32')
+            self.map     = np.zeros(shape[1:], 'float32')
+            self.hp_fast = np.zeros(shape[1:], 'float32')
+            self.hp_slow = np.zeros(shape[1:], 'float32')
+        (f_lo, f_hi) = self.heart
+        _highpass = poormansHighpassProcessor.highpassKernel
+        _highpass(self.binned[0].reshape(-1), np.float32(self._alpha(self.fs, f_hi)), self.fast.reshape(-1), self.hp_fast.reshape(-1))
+        _highpass(self.binned[0].reshape(-1), np.float32(self._alpha(self.fs, f_lo)), self.slow.reshape(-1), self.hp_slow.reshape(-1))
+        bandpass = np.subtract(self.hp_slow, self.hp_fast, out=self.hp_slow)                 # fast - slow lowpass
+        np.multiply(bandpass, bandpass, out=bandpass)
+        _highpass(bandpass.reshape(-1), np.float32(self._alpha(self.fs, 0.5*f_lo)), self.power.reshape(-1), self.hp_fast.reshape(-1))
+        np.sqrt(self.power, out=self.map)
+        np.divide(self.map, self.slow, out=self.map, where=self.slow > 0.)
+        self.map[self.slow <= 0.] = 0.
+        return self.map
+
+    def toImage(self, displayImage):
+        """ Scale pulse map to 8 bit and fit it into top left of displayImage """
+        if self.map is None: return
+        if self.image is None or self.image.shape != self.map.shape:
+            self.image = np.empty(self.map.shape, 'uint8')
+        cv2.normalize(self.map, self.image, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+        (height, width) = self.image.shape
+        (newHeight, newWidth) = displayImage.shape[:2]
+        scale = min(newHeight/height, newWidth/width)
+        (tw, th) = (int(width*scale), int(height*scale))
+        cv2.resize(self.image, (tw, th), dst=displayImage[:th, :tw], interpolation=cv2.INTER_NEAREST)
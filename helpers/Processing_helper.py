@@ -2,60 +2,948 @@
 import numpy as np
 from   numba import vectorize, jit, prange
 import cv2
+import ast
 import math
 import time
 import logging
+import threading
+import collections
+import multiprocessing
+from   multiprocessing import shared_memory
 
-from PyQt5.QtCore import QObject, QTimer, QThread, pyqtSignal, pyqtSlot, QSignalMapper
+from PyQt5.QtCore import Qt, QObject, QTimer, QThread, pyqtSignal, pyqtSlot, QSignalMapper
 from PyQt5.QtWidgets import QLineEdit, QSlider, QCheckBox, QLabel
 
+# Slot states of the data cube ring buffer
+SLOT_EMPTY      = 0                                                                 # free, capture may fill it
+SLOT_FILLING    = 1                                                                 # capture is writing images into it
+SLOT_READY      = 2                                                                 # complete, waiting for consumer
+SLOT_PROCESSING = 3                                                                 # consumer is holding it
+
+# Overflow policies of the processing queue
+QUEUE_DROP_OLDEST = 0                                                               # release oldest queued cube, keep newest
+QUEUE_DROP_NEWEST = 1                                                               # release new cube, keep queued ones
+QUEUE_BLOCK       = 2                                                               # block capture until there is space
+
+# Temporal filters of the processing worker
+TEMPORAL_EQUALIZER = 0                                                              # three band equalizer
+TEMPORAL_HIGHPASS  = 1                                                              # poor man's highpass, cut off at low frequency
+TEMPORAL_RUNNINGSUM = 2                                                             # running sum highpass, cut off at low frequency
+
+###############################################################################
+# Stage Statistics
+# Latency of each stage is counted in a histogram with logarithmic bins,
+# 20 bins per decade from 1 us to 10 s (12% wide), recording is constant time
+# and does not allocate. Percentiles are read from the cumulative histogram.
+# Histograms cover the interval since the last summary, throughput is the
+# number of recordings per second in that interval.
+###############################################################################
+
+class stageStatistics():
+    """
+    Stage Statistics
+    Per stage latency histograms, stages are added when they are recorded first.
+    Stages can be recorded from different threads.
+
+      record   add latency [s] of one run of stage
+      summary  {stage: [per second, p50, p95, p99, mean in ms]} since last summary, histograms restart
+    """
+
+    BINS_PER_DECADE = 20
+    T_MIN           = 1e-6                                                         # lower edge of first bin [s]
+    BINS            = 7*BINS_PER_DECADE                                            # up to 10 s
+
+    def __init__(self):
+
+        self.lock    = threading.Lock()
+        self.counts  = collections.OrderedDict()                                   # stage: histogram
+        self.totals  = {}                                                          # stage: summed latency
+        self._start  = time.perf_counter()                                         # begin of current interval
+        # bin centers in ms
+        self.centers = 1000.*self.T_MIN*10.**((np.arange(self.BINS) + 0.5)/self.BINS_PER_DECADE)
+
+    def record(self, stage: str, seconds: float):
+        i = int(math.log10(seconds/self.T_MIN)*self.BINS_PER_DECADE) if seconds > self.T_MIN else 0
+        i = min(i, self.BINS-1)
+        with self.lock:
+            if stage not in self.counts:
+                self.counts[stage] = np.zeros(self.BINS, 'int64')
+                self.totals[stage] = 0.
+            self.counts[stage][i] += 1
+            self.totals[stage]    += seconds
+
+    def summary(self):
+        current_time = time.perf_counter()
+        with self.lock:
+            interval    = max(current_time - self._start, 1e-9)
+            self._start = current_time
+            stages = [(stage, counts.copy(), self.totals[stage]) for (stage, counts) in self.counts.items()]
+            for stage in self.counts:
+                self.counts[stage][:] = 0
+                self.totals[stage]    = 0.
+        result = collections.OrderedDict()
+        for (stage, counts, total) in stages:
+            n = int(counts.sum())
+            if n == 0: continue
+            cdf = np.cumsum(counts)
+            p50, p95, p99 = self.centers[np.searchsorted(cdf, np.array([0.5, 0.95, 0.99])*n)].tolist()
+            result[stage] = [n/interval, p50, p95, p99, 1000.*total/n]
+        return result
+
+###############################################################################
+# Processing Pipeline
+# Stages are run in the order they were added, each one reads the output of its
+# source stage, None is the input of the pipeline. When the pipeline is built
+# every enabled stage allocates its buffers for the shape and type of its input
+# and reports shape and type of its output. Disabled stages are left out of the
+# plan, their consumers are left out as well, nothing is copied through.
+###############################################################################
+
+class pipelineStage():
+    """
+    Pipeline Stage
+      build(shape, dtype)  allocate buffers for input, returns (shape, dtype) of output or None if stage has no output
+      run(data)            process input, returns output
+    """
+
+    def __init__(self, name: str, build, run, source: str = None, enabled: bool = True):
+
+        self.name    = name                                                        # referenced by consumers
+        self.build   = build
+        self.run     = run
+        self.source  = source                                                      # stage providing input, None = pipeline input
+        self.enabled = enabled
+
+class processingPipeline():
+    """
+    Processing Pipeline
+    Plan of enabled stages and their buffers is built once per input shape and type
+    and rebuilt with the next cube when a stage is enabled or disabled.
+    With stats each stage run is timed.
+
+      add      append stage
+      enable   turn stage on or off
+      build    plan and allocate stages for input shape and type
+      run      run plan, returns outputs by stage name
+    """
+
+    def __init__(self, stats: stageStatistics = None):
+
+        self.logger = logging.getLogger("Pipe___")
+
+        self.stats   = stats                                                       # latency of each stage, None = not timed
+        self.stages  = collections.OrderedDict()                                   # name: pipelineStage
+        self.plan    = []                                                          # enabled stages with available input
+        self.specs   = {}                                                          # name: (shape, dtype) of output
+        self.outputs = {}                                                          # name: output of last run
+        self.key     = None                                                        # input shape and type of plan
+        self.dirty   = True                                                        # plan needs to be rebuilt
+
+    def add(self, stage: pipelineStage):
+        self.stages[stage.name] = stage
+        self.dirty = True
+
+    def enable(self, name: str, enabled: bool = True):
+        """ Turn stage on or off, plan is rebuilt with next run """
+        stage = self.stages[name]
+        if stage.enabled != enabled:
+            stage.enabled = enabled
+            self.dirty    = True
+
+    def enabled(self, name: str):
+        """ Stage is in current plan """
+        return any(stage.name == name for stage in self.plan)
+
+    def build(self, shape, dtype):
+        """ Plan enabled stages whose source is in the plan, each stage allocates for its input """
+        self.specs = {None: (shape, np.dtype(dtype))}
+        self.plan  = []
+        for stage in self.stages.values():
+            if not stage.enabled or stage.source not in self.specs: continue
+            spec = stage.build(*self.specs[stage.source])
+            if spec is not None: self.specs[stage.name] = (tuple(spec[0]), np.dtype(spec[1]))
+            self.plan.append(stage)
+        self.outputs = {}
+        self.key     = (tuple(shape), np.dtype(dtype))
+        self.dirty   = False
+        self.logger.log(logging.INFO, "Status:Pipeline {}.".format(" > ".join(stage.name for stage in self.plan)))
+
+    def run(self, data, shape, dtype, provided: dict = {}):
+        """
+        Run plan on data of shape and dtype, plan is rebuilt if input or stages changed
+        provided are outputs computed elsewhere, these stages are not run
+        """
+        if self.dirty or self.key != (tuple(shape), np.dtype(dtype)):
+            self.build(shape, dtype)
+        outputs = self.outputs
+        outputs[None] = data
+        for stage in self.plan:
+            if stage.name in provided:
+                outputs[stage.name] = provided[stage.name]
+                continue
+            start_time = time.perf_counter()
+            outputs[stage.name] = stage.run(outputs[stage.source])
+            if self.stats is not None: self.stats.record(stage.name, time.perf_counter() - start_time)
+        return outputs
+
 class QProcessWorker(QObject):
     """ 
     Process Worker Class
+    Goes to separate thread
+
+    Completed data cubes are handed over from the capture thread into a bounded queue.
+    If the queue is full the policy decides:
+      QUEUE_DROP_OLDEST  oldest queued cube is released to the ring buffer
+      QUEUE_DROP_NEWEST  new cube is released to the ring buffer
+      QUEUE_BLOCK        capture thread waits until processing made space
+    Queue holds only slot indices, the cube stays in the ring buffer of the data cube.
+    Ring buffer needs at least maxsize + 3 slots, otherwise it drops cubes before the queue policy applies.
+    If a displayTap is attached, the display image is built only when the tap is due.
+    One cube is processed per event so that other slots of this worker remain responsive.
+    With processes > 0 and a data cube in shared memory, cubes are handed to a cubeProcessPool,
+    up to one cube per worker process is in flight. Background removal, flatfield correction and
+    binning run in the worker processes, their result is the 'correct' output of the pipeline and
+    the remaining stages run on it in this thread. The slot is released after that.
+    Workers finish in any order, the recursive stages need the cubes in capture order. Cubes wait
+    in a reorder buffer keyed by their sequence number until all earlier cubes were run, cubes dropped
+    by the queue or the ring buffer never enter it. Unmixing stays in this thread, NNLS starts from
+    the solution of the previous cube and least squares is one multithreaded matrix multiplication.
+    The 'correct' stage runs only if a later stage or the rois read it. Without background, flatfield
+    and binning its output is the raw slot, scale converts raw values to corrected values.
 
     Signals      
-        = For processWorker
-        NEED TO DEVELOP
+        fpsReady            processed cubes per second
+        queueStatusReady    [queue depth, cubes dropped by queue, cubes dropped by ring buffer]
+        spectrumReady       mean and standard deviation spectrum of each roi, at display rate
+        physioReady         heart and respiration rate of each roi, at display rate
+        statsReady          rate and latency of capture, sort, pipeline stages and display, every stats_interval
     Slots
+      on_dataCubeReady      called in capture thread (direct connection), queues cube
+      on_processRequest     process next cube in queue
+      on_poolResult         cube corrected by process pool, run remaining pipeline stages
       on_changeBinning
-      on_processRequest
-      
+      on_setCorrection      background subtraction and flatfield correction on or off
+      on_setDisplayedChannels
+      on_setColorChannels   pseudo color composite instead of mosaic
+      on_setChannelMath     operation between two channels, optionally displayed instead of mosaic
+      on_setROIs            rois in display image coordinates for spectrum and physio
+      on_setPhysio          heart and respiration rate, optionally pulse map displayed instead of mosaic
+      on_setTemporalFilter  gains and band edges of three band equalizer or cut off of highpass,
+                            filtered cube is displayed instead of mosaic
+      on_setChromophores
+      on_stop               release queued cubes and unblock capture
     """
 
+    fpsReady           = pyqtSignal(float)                                         # processed cubes per second
+    queueStatusReady   = pyqtSignal(list)                                          # queue depth and dropped cubes
+    spectrumReady      = pyqtSignal(np.ndarray)                                    # rois x mean, std x channels
+    physioReady        = pyqtSignal(np.ndarray)                                    # rois x heart, respiration rate per minute
+    statsReady         = pyqtSignal(dict)                                          # stage: [per second, p50, p95, p99, mean in ms]
+    processRequest     = pyqtSignal()                                              # there are cubes in the queue
+    poolResultReady    = pyqtSignal(object, int, bool)                             # datacube, slot, success from process pool
+
+    def __init__(self, parent=None, maxsize: int = 2, policy: int = QUEUE_DROP_OLDEST, processes: int = 0, display_res: tuple = (720, 540),
+                 temporal_filter: int = TEMPORAL_EQUALIZER, stats_interval: float = 5.):
+        super(QProcessWorker, self).__init__(parent)
+
+        self.logger = logging.getLogger("QProcW_")
+
+        self.queue       = collections.deque()                                     # (datacube, slot) waiting for processing
+        self.queue_cond  = threading.Condition()                                   # capture and processing thread access queue
+        self.maxsize     = maxsize                                                 # maximum number of queued cubes
+        self.policy      = policy                                                  # what to do when queue is full
+        self.dropped     = 0                                                       # cubes dropped by queue
+        self.stopped     = False
+        self._scheduled  = False                                                   # processRequest is pending
+        self.binning     = (1,1)                                                   # vertical, horizontal
+        self.out         = None                                                    # processed cube, allocated once per setting
+        self.corrected   = None                                                    # corrected cube of last cube, out, raw slot or pool result
+        self.scale       = 1.                                                      # corrected value per value in corrected, > 1 for raw slot
+        self.processes   = processes                                               # worker processes, 0 = process in this thread
+        self.pool        = None                                                    # process pool for shared memory data cube
+        self.pool_lock   = threading.Lock()                                        # processing thread uses pool, on_stop closes it
+        self.reorder     = collections.OrderedDict()                               # seq: [datacube, slot, due, settings, pooled, done, success] in capture order
+        self.displayTap  = None                                                    # forwards display images at display rate
+        self.display_res = display_res                                             # width, height of display image
+        self.displayImage = np.zeros((display_res[1], display_res[0]), 'uint8')    # display image, reused, displayed through color table
+        self.processedImage = np.zeros((display_res[1], display_res[0]), 'uint8')  # channel math or pulse map, separate from mosaic
+        self._processed  = None                                                    # processor drawn into processedImage
+        self.filteredDisplay = filteredDisplayProcessor()                          # mosaic of temporally filtered cube
+        self.display_indx = [0]                                                    # displayed channels in sorted cube
+        self.display_name = []                                                     # names of displayed channels
+        self.colorImage  = np.zeros((display_res[1], display_res[0], 3), 'uint8')  # pseudo color display image, BGR
+        self.color_indx  = []                                                      # red, green, blue channel in sorted cube, empty = off
+        self.color_luts  = None                                                    # red, green, blue lookup tables
+        self.color_lut_settings = ([1.,1.,1.], [0.,0.,0.], 1.)                     # gain, offset, gamma
+        self.channelMath = channelMathProcessor()                                  # First/Second channel operation
+        self.display_analysis = False                                              # display channel math instead of mosaic
+        self.spectrum    = roiSpectrumProcessor()                                  # ROI spectra
+        self.display_rois = []                                                     # (x, y, width, height) in display image
+        self.temporal_filter = temporal_filter                                     # TEMPORAL_EQUALIZER, _HIGHPASS or _RUNNINGSUM
+        self.filter      = None                                                    # temporal filter processor, allocated per resolution
+        self.filter_binning = (1,1)                                                # binning of filter state
+        self.filter_scale = 1.                                                     # scale of filter state
+        self.temporal    = None                                                    # [gain low, mid, high, fc low, fc high, fs]
+        self.filtered    = None                                                    # temporally filtered cube
+        self.physio      = None                                                    # physioProcessor
+        self.physio_indx = 0                                                       # physio channel in sorted cube
+        self.display_physio = False                                                # display pulse map instead of mosaic
+        self.unmixer     = None                                                    # spectralUnmixingProcessor
+        self.concentrations = None                                                 # chromophore maps of last cube
+        self.background  = True                                                    # subtract background
+        self.flatfield   = True                                                    # apply flatfield correction
+        self.datacube    = None                                                    # data cube of processed slot
+        self.slot        = 0                                                       # processed slot
+        self.stats       = stageStatistics()                                       # latency of pipeline stages and display
+        self.stats_interval = stats_interval                                       # seconds between statistics
+        self.pipeline    = self._createPipeline()                                  # correction, filter and analysis stages
+
+        self.measured_fps = 0.0
+        self._last_time   = self._last_emit = self._last_stats = time.perf_counter()
+
+        self.processRequest.connect(self.on_processRequest, Qt.QueuedConnection)  # always through event loop of processing thread
+        self.poolResultReady.connect(self.on_poolResult, Qt.QueuedConnection)     # from result thread of pool
+
+        self.logger.log(logging.INFO, "[{}]: initialized.".format(int(QThread.currentThreadId())))
+
+    @pyqtSlot(object, int)
+    def on_dataCubeReady(self, datacube, slot):
+        """ Queue completed cube, runs in capture thread """
+        if datacube.acquire(slot) is None: return
+        with self.queue_cond:
+            if len(self.queue) >= self.maxsize:
+                if self.policy == QUEUE_DROP_NEWEST:
+                    datacube.release(slot)
+                    self.dropped += 1
+                    return
+                elif self.policy == QUEUE_DROP_OLDEST:
+                    (_datacube, _slot) = self.queue.popleft()
+                    _datacube.release(_slot)
+                    self.dropped += 1
+                else: # QUEUE_BLOCK
+                    while len(self.queue) >= self.maxsize and not self.stopped:
+                        self.queue_cond.wait(0.1)
+                    if self.stopped:
+                        datacube.release(slot)
+                        return
+            self.queue.append((datacube, slot))
+            schedule = not self._scheduled
+            self._scheduled = True
+        if schedule: self.processRequest.emit()                                    # queued to processing thread
+
+    @pyqtSlot()
+    def on_processRequest(self):
+        """ Process oldest cube in queue """
+        pool = self.pool
+        with self.queue_cond:
+            if not self.queue or (pool is not None and pool.busy):
+                self._scheduled = False                                            # pool result or new cube reschedules
+                return
+            (datacube, slot) = self.queue.popleft()
+            self.queue_cond.notify()                                               # unblock capture
+        due = self.displayTap is not None and self.displayTap.due()                # only build display image at display rate
+        local = not (self.processes > 0 and datacube.shm is not None) or not self._pooled()
+        processed = self._processedDisplay()                                       # display built from processed cube
+        if due and processed is not self._processed:                               # other display, images and layout restart
+            self.processedImage[:] = 0
+            datacube._layout_key = None
+            self._processed = processed
+        if due and processed is None:
+            start_time = time.perf_counter()
+            if len(self.color_indx) == 3:
+                if self.color_luts is None or self.color_luts.shape[1] != 2**datacube.bits:
+                    self.color_luts = self._colorLUTs(datacube.bits)
+                datacube.cube2ColorImage(slot, self.colorImage, self.color_indx, self.color_luts)
+                self.displayTap.put(self.colorImage)
+            else:
+                datacube.cube2DisplayImage(slot, self.displayImage, self.display_indx, self.display_name)
+                self.displayTap.put(self.displayImage)
+            self.stats.record('display', time.perf_counter() - start_time)
+        if not local:
+            self._submit(datacube, slot, due)
+        elif not self._defer(datacube, slot, due):
+            try:
+                self.process(datacube, slot)
+                self._analyze(datacube, due)                                       # raw slot is read until here
+            finally:
+                datacube.release(slot)
+            self._updateStatus(datacube)
+        with self.queue_cond:
+            if self.queue: 
+                self.processRequest.emit()                                         # next cube after pending events
+            else:
+                self._scheduled = False
+
+    def _analyze(self, datacube, due):
+        """ Processed display, roi spectrum and physio rates at display rate """
+        processed = self._processedDisplay()
+        if due and processed is not None and processed is self._processed:        # display did not change since cube was taken
+            start_time = time.perf_counter()
+            if processed is self.filteredDisplay:
+                processed.setLayout(datacube._mosaicLayout(self.processedImage, self.display_indx, self.display_name), self.display_indx)
+            processed.toImage(self.processedImage)
+            self.displayTap.put(self.processedImage)
+            self.stats.record('display', time.perf_counter() - start_time)
+        if due and len(self.display_rois) > 0:                                     # spectrum is plotted at display rate
+            start_time = time.perf_counter()
+            self.spectrum.rois = self._roisInCube(datacube)
+            spectra = self.spectrum.compute(self.corrected, self.binning)
+            if self.scale != 1.: spectra *= self.scale                             # raw slot in corrected units
+            self.spectrumReady.emit(spectra)
+            self.stats.record('spectrum', time.perf_counter() - start_time)
+        if due and self.physio is not None and self.physio.enabled:
+            self.physioReady.emit(self.physio.rates())
+
+    def _submit(self, datacube, slot, due):
+        """ Hand cube to process pool, on_poolResult continues in this thread when worker is done """
+        with self.pool_lock:
+            if self.pool is None or self.pool.datacube is not datacube:
+                if self.pool is not None: self.pool.close()
+                self._flush()                                                      # results of closed pool will not arrive
+                self.pool = cubeProcessPool(datacube, self.processes)
+            self.reorder[int(datacube.slot_seq[slot])] = [datacube, slot, due, (self.binning, self._raw()), True, False, False]
+            start_time = time.perf_counter()
+            def _done(slot, success):                                              # runs in result thread of pool
+                self.stats.record('pool', time.perf_counter() - start_time)
+                self.poolResultReady.emit(datacube, slot, success)                 # queued to processing thread
+            self.pool.submit(slot, self.binning, self.background, self.flatfield, _done)
+
+    def _defer(self, datacube, slot, due):
+        """ Cube waits in reorder buffer if earlier cubes are still in process pool, on_poolResult runs it """
+        with self.pool_lock:
+            if not self.reorder: return False
+            self.reorder[int(datacube.slot_seq[slot])] = [datacube, slot, due, (self.binning, self._raw()), False, True, True]
+            return True
+
+    @pyqtSlot(object, int, bool)
+    def on_poolResult(self, datacube, slot, success):
+        """ Mark cube from process pool done, run pipeline on done cubes in capture order, then release their slots """
+        with self.pool_lock:                                                       # result is in shared memory of pool
+            entry = self.reorder.get(int(datacube.slot_seq[slot]))
+            if self.pool is None or entry is None or entry[0] is not datacube:     # pool was closed, slot was released
+                return
+            entry[5:7] = [True, success]
+            while self.reorder:
+                (seq, (datacube, slot, due, settings, pooled, done, success)) = next(iter(self.reorder.items()))
+                if not done: break                                                 # wait for next cube in capture order
+                del self.reorder[seq]
+                try:
+                    if success and (not pooled or settings == (self.binning, self._raw())): # otherwise result does not fit plan, cube is skipped
+                        self.process(datacube, slot, self.pool.result(slot) if pooled else None)
+                        self._analyze(datacube, due)
+                finally:
+                    datacube.release(slot)
+                self._updateStatus(datacube)
+        with self.queue_cond:
+            if self.queue and not self._scheduled:
+                self._scheduled = True
+                self.processRequest.emit()
+
+    def process(self, datacube, slot, corrected=None):
+        """
+        Background removal, flatfield correction, binning, temporal filter, channel math, physio and spectral unmixing
+        corrected is the result of the process pool, correction is skipped
+        """
+        self.datacube = datacube
+        self.slot     = slot
+        outputs = self.pipeline.run((datacube, slot), (datacube.depth, datacube.height, datacube.width), datacube.cubes.dtype,
+                                    {} if corrected is None else {'correct': corrected})
+        self.corrected = outputs.get('correct')                                    # None if no stage reads it
+        return self.corrected
+
+    def _createPipeline(self):
+        """ Corrected cube feeds temporal filter and analysis, stages are enabled by their settings """
+        pipeline = processingPipeline(self.stats)
+        pipeline.add(pipelineStage('correct',     self._buildCorrect,  self._correct, enabled=False))
+        pipeline.add(pipelineStage('temporal',    self._buildTemporal, self._temporal, 'correct', enabled=False))
+        pipeline.add(pipelineStage('channelmath', self._buildMath,     self._math, 'correct', enabled=False))
+        pipeline.add(pipelineStage('physio',      lambda shape, dtype: None, self._physio, 'correct', enabled=False))
+        pipeline.add(pipelineStage('unmix',       self._buildUnmix,    self._unmix, 'correct', enabled=False))
+        return pipeline
+
+    def _enableCorrect(self):
+        """ Correction runs only if a later stage or the rois read it """
+        consumers = any(self.pipeline.stages[name].enabled for name in ('temporal', 'channelmath', 'physio', 'unmix'))
+        self.pipeline.enable('correct', consumers or len(self.display_rois) > 0)
+
+    def _raw(self):
+        """ No background, flatfield and binning, consumers read the raw slot """
+        return not self.background and not self.flatfield and self.binning == (1, 1)
+
+    def _pooled(self):
+        """ Correction is worth a worker process """
+        return self.pipeline.stages['correct'].enabled and not self._raw()
+
+    def _buildCorrect(self, shape, dtype):
+        """ Corrected cube, binning is fused into correction, raw slot is sorted in place of correction """
+        (by, bx) = self.binning
+        (depth, height, width) = shape
+        if self._raw():
+            datacube = self.datacube
+            self.scale = float(1 << (datacube.ff_bits - datacube.shift))           # what unity flatfield would multiply by
+        elif by == 1 and bx == 1:
+            shape, dtype, self.scale = (depth, height, width), np.uint16, 1.
+        else:
+            shape, dtype, self.scale = (depth, height//by, width//bx), QDataCube.binDtype(16, by, bx), 1.
+        if self.out is None or self.out.shape != shape or self.out.dtype != dtype:
+            self.out = np.zeros(shape, dtype)
+        return (shape, dtype)
+
+    def _correct(self, data):
+        (datacube, slot) = data
+        if self._raw():
+            if datacube.slot_start[slot] == 0: return datacube.cubes[slot]        # background phase locked, slot is sorted
+            return np.take(datacube.cubes[slot], datacube.order(slot), axis=0, out=self.out)
+        if self.binning == (1, 1): return datacube.bgflat(slot, self.out, self.background, self.flatfield)
+        else:                      return datacube.bgflatbin(slot, self.binning, self.out, self.background, self.flatfield)
+
+    def _buildTemporal(self, shape, dtype):
+        """ New filter or filter state resampled to binning and scale, running sum needs new delay line """
+        ((by, bx), (oy, ox)) = (self.binning, self.filter_binning)
+        scale = (by*bx)/(oy*ox) * self.filter_scale/self.scale                     # new value per old value
+        if self.filter is None or (self.temporal_filter == TEMPORAL_RUNNINGSUM and
+                                   (self.filter.res != shape or self.filter.delay_line.dtype != dtype or scale != 1.)):
+            self._createTemporalFilter(shape, dtype)
+        elif self.filter.res != shape or scale != 1.:                              # binning or correction changed
+            self.filter.resample(shape, scale)
+        self.filter_binning = self.binning
+        self.filter_scale   = self.scale
+        self.filteredDisplay.scale = self.scale
+        return (shape, np.float32)
+
+    def _temporal(self, data):
+        if self.temporal_filter == TEMPORAL_EQUALIZER: self.filtered = self.filter.equalize(data)
+        else:                                          self.filtered = self.filter.highpass(data)
+        self.filteredDisplay.data = self.filtered
+        return self.filtered
+
+    def _buildMath(self, shape, dtype):
+        self.channelMath.allocate(shape[1:])
+        return (shape[1:], np.float32)
+
+    def _math(self, data):
+        return self.channelMath.compute(data, self.scale)
+
+    def _buildUnmix(self, shape, dtype):
+        self.unmixer._allocate(shape)
+        return ((len(self.unmixer.names),) + tuple(shape[1:]), np.float32)
+
+    def _unmix(self, data):
+        self.concentrations = self.unmixer.unmix(self.unmixer.absorbance(data, self.binning[0]*self.binning[1], self.scale))
+        return self.concentrations
+
+    def _updateStatus(self, datacube):
+        current_time = time.perf_counter()
+        self.measured_fps = (0.9 * self.measured_fps) + (0.1/(current_time - self._last_time)) # low pass filter
+        self._last_time = current_time
+        if current_time - self._last_emit > 0.5:
+            self.fpsReady.emit(self.measured_fps)
+            self.queueStatusReady.emit([len(self.queue), self.dropped, datacube.dropped])
+            self._last_emit = current_time
+            self.logger.log(logging.DEBUG, "[{}]: FPS: {:.1f} queue: {} dropped: {} {}.".format(
+                int(QThread.currentThreadId()), self.measured_fps, len(self.queue), self.dropped, datacube.dropped))
+            if self.unmixer is not None and len(self.unmixer.names) > 0:
+                self.logger.log(logging.DEBUG, "[{}]: Unmixing {:.1f} ms per cube.".format(
+                    int(QThread.currentThreadId()), self.unmixer.unmix_time))
+        if current_time - self._last_stats > self.stats_interval:
+            self._last_stats = current_time
+            stats = datacube.stats.summary()
+            stats.update(self.stats.summary())
+            if not stats: return
+            self.statsReady.emit(dict(stats))
+            slowest = max(stats, key=lambda stage: stats[stage][4] if stage not in ('capture', 'assembly') else 0.)
+            self.logger.log(logging.INFO, "[{}]: Stages [per second, p50/p95/p99 ms]: {}, slowest {}.".format(
+                int(QThread.currentThreadId()),
+                ", ".join("{} {:.1f} {:.2f}/{:.2f}/{:.2f}".format(stage, rate, p50, p95, p99) for (stage, (rate, p50, p95, p99, mean)) in stats.items()),
+                slowest))
+
+    @pyqtSlot(np.ndarray, list)
+    def on_setDisplayedChannels(self, indx, name):
+        self.display_indx = list(indx)
+        self.display_name = name
+
+    def _colorLUTs(self, bits):
+        (gain, offset, gamma) = self.color_lut_settings
+        return np.stack([QDataCube.colorLUT(bits, gain[i], offset[i], gamma) for i in range(3)])
+
+    def setColorLUT(self, gain: list = [1.,1.,1.], offset: list = [0.,0.,0.], gamma: float = 1.):
+        """ Red, green and blue gain and offset and gamma of pseudo color composite """
+        self.color_lut_settings = (gain, offset, gamma)
+        self.color_luts = None                                                     # rebuilt for bit depth of next cube
+
     @pyqtSlot(list)
-    def on_changeBinning(self, binning):
+    def on_setColorChannels(self, indx):
+        """ Red, green and blue channel in sorted cube, empty list displays mosaic """
+        self.color_indx = list(indx)
+
+    @pyqtSlot(list, str, bool)
+    def on_setChannelMath(self, indx, operation, display):
+        """ Operation between channels a and b in sorted cube, empty indx turns it off """
+        if len(indx) == 2: self.channelMath.setOperation(indx, operation)
+        else:              self.channelMath.indx = []
+        self.display_analysis = display
+        self.pipeline.enable('channelmath', len(self.channelMath.indx) == 2)
+        self._enableCorrect()
+
+    def _physio(self, data):
+        """ Pulse map of physio channel and roi means from binned pulse map, whole image if there are no rois """
+        datacube = self.datacube
+        image = self.physio.pulseMap(data[self.physio_indx])
+        binned = self.physio.binned[0]
+        (sy, sx) = (self.binning[0]*self.physio.binning, self.binning[1]*self.physio.binning)
+        means = []
+        for roi in (self._roisInCube(datacube) if len(self.display_rois) > 0 else [(0, 0, datacube.width, datacube.height)]):
+            if roi is None:
+                means.append(0.)
+                continue
+            (x, y, w, h) = roi
+            x0 = min(int(x)//sx, binned.shape[1]-1); x1 = max(int(x+w)//sx, x0+1)
+            y0 = min(int(y)//sy, binned.shape[0]-1); y1 = max(int(y+h)//sy, y0+1)
+            means.append(binned[y0:y1, x0:x1].mean())
+        self.physio.update(means, datacube.slot_time[self.slot])                  # capture time, not processing time
+
+    def _processedDisplay(self):
+        """ Processor whose result is displayed instead of the mosaic, None displays mosaic or color """
+        if self.display_analysis and len(self.channelMath.indx) == 2:        return self.channelMath
+        if self.display_physio and self.physio is not None and self.physio.enabled: return self.physio
+        if self.pipeline.enabled('temporal') and self.filteredDisplay.data is not None and len(self.color_indx) != 3:
+            return self.filteredDisplay
+        return None
+
+    def _roisInCube(self, datacube):
+        """ Map rois from display image to cube, roi needs to start within a tile of the displayed image, otherwise None """
+        processed = self._processedDisplay()
+        if len(self.color_indx) == 3 or processed not in (None, self.filteredDisplay) or datacube._layout is None:
+            (newHeight, newWidth) = self.displayImage.shape
+            scale = min(newHeight/datacube.height, newWidth/datacube.width)
+            (tiles, (tw, th)) = ([(0, 0)], (int(datacube.width*scale), int(datacube.height*scale)))
+        else:
+            (tiles, (tw, th)) = (datacube._layout["tiles"], datacube._layout["dsize"])
+        rois = []
+        for (x, y, w, h) in self.display_rois:
+            roi = None
+            for (ty, tx) in tiles:
+                if tx <= x < tx + tw and ty <= y < ty + th:
+                    (sx, sy) = (datacube.width/tw, datacube.height/th)
+                    roi = ((x-tx)*sx, (y-ty)*sy, w*sx, h*sy)
+                    break
+            rois.append(roi)
+        return rois
+
+    @pyqtSlot(list)
+    def on_setROIs(self, rois):
+        """ rois (x, y, width, height) in display image coordinates, empty list turns spectrum off """
+        self.display_rois = list(rois)
+        self._enableCorrect()
+
+    def _createTemporalFilter(self, res, dtype):
+        (gl, gm, gh, fl, fh, fs) = self.temporal
+        if self.temporal_filter == TEMPORAL_HIGHPASS:
+            self.filter = poormansHighpassProcessor(res, poormansHighpassProcessor.computeAlpha(fs, fl))
+        elif self.temporal_filter == TEMPORAL_RUNNINGSUM:
+            self.filter = runningsumHighpassProcessor(res, runningsumHighpassProcessor.computeDelay(fs, fl), dtype)
+        else:
+            self.filter = threeBandEqualizerProcessor(res, gl, gm, gh, fl, fh, fs)
 
+    @pyqtSlot(bool, list)
+    def on_setTemporalFilter(self, enable, settings):
+        """ 
+        Temporal filter settings are [gain low, mid, high, fc low, fc high, fs], filter state is kept
+        Highpass and running sum use fc low as cut off frequency
+        """
+        self.temporal = list(settings)
+        self.pipeline.enable('temporal', enable)
+        self._enableCorrect()
+        if enable and self.filter is not None:
+            (gl, gm, gh, fl, fh, fs) = self.temporal
+            if self.temporal_filter == TEMPORAL_HIGHPASS:
+                self.filter.alpha = poormansHighpassProcessor.computeAlpha(fs, fl)
+            elif self.temporal_filter == TEMPORAL_RUNNINGSUM:
+                if self.filter.delay != runningsumHighpassProcessor.computeDelay(fs, fl):
+                    self.filter = None                                             # new delay line with next cube
+                    self.pipeline.dirty = True
+            else:
+                self.filter.setGains(gl, gm, gh)
+                self.filter.setFrequencies(fl, fh, fs)
+
+    @pyqtSlot(np.ndarray, bool)
+    def on_setPhysio(self, measured, display):
+        """ Physio on configured LED channel, display shows pulse map instead of mosaic """
+        self.display_physio = display
+        if self.physio is None: return
+        channel = self.physio.channel if self.physio.channel > 0 else int(np.argmax(measured[1:])) + 1
+        self.physio.enabled = display and channel < len(measured) and bool(measured[channel])
+        if display and not self.physio.enabled:
+            self.logger.log(logging.ERROR, "Status:Physio channel {} is not measured!".format(channel))
+        self.physio_indx = int(np.count_nonzero(measured[:channel]))
+        self.pipeline.enable('physio', self.physio.enabled)
+        self._enableCorrect()
+
+    @pyqtSlot(list, np.ndarray)
+    def on_setChromophores(self, names, measured):
+        """ Unmix selected chromophores, measured are the measured channels with background at 0 """
+        if self.unmixer is None: return
+        self.unmixer.setChromophores(names, np.nonzero(measured)[0][1:])
+        self.pipeline.enable('unmix', len(self.unmixer.names) > 0)
+        self._enableCorrect()
+        self.pipeline.dirty = True                                                 # number of chromophores changed
+
+    @pyqtSlot(list)
+    def on_changeBinning(self, binning):
+        """ Binning [vertical, horizontal], temporal filter state follows with the next cube """
+        self.binning = (int(binning[0]), int(binning[1]))
+        self.pipeline.dirty = True                                                 # new output shape
+        self.logger.log(logging.INFO, "[{}]: binning {}.".format(int(QThread.currentThreadId()), self.binning))
+
+    @pyqtSlot(bool, bool)
+    def on_setCorrection(self, background, flatfield):
+        """ Background subtraction and flatfield correction on or off, acquisition continues """
+        raw = self._raw()
+        self.background = background
+        self.flatfield  = flatfield
+        if self._raw() != raw: self.pipeline.dirty = True                          # raw slot or corrected cube
+        self.logger.log(logging.INFO, "[{}]: background {} flatfield {}.".format(int(QThread.currentThreadId()), background, flatfield))
+
+    @pyqtSlot()
+    def on_stop(self):
+        """ Release queued cubes and unblock capture """
+        with self.queue_cond:
+            self.stopped = True
+            while self.queue:
+                (datacube, slot) = self.queue.popleft()
+                datacube.release(slot)
+            self.queue_cond.notify_all()
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool = None
+            self._flush()
+
+    def _flush(self):
+        """ Release cubes in reorder buffer, results of closed pool will not arrive """
+        for (datacube, slot, due, settings, pooled, done, success) in self.reorder.values():
+            datacube.release(slot)
+        self.reorder.clear()
+
+    @pyqtSlot()
+    def on_start(self):
+        with self.queue_cond:
+            self.stopped = False
     
-class QDataCube():
+class QDisplayTap(QObject):
+    """
+    Display Tap
+    Lives in GUI thread, forwards at most displayfps images per second.
+    Processing thread checks due() before building a display image and hands it over with put().
+    Only the latest image is kept (coalescing), there is at most one delivery pending 
+    in the GUI event loop. put() copies into the back buffer, delivery swaps front and back 
+    buffer in GUI thread so the displayed image is never overwritten while it is rendered.
+    With stats, the wait in the GUI event loop (delivery) and the handling of imageDataReady
+    in the GUI thread (render) are recorded.
+
+    Signals
+        imageDataReady      display image for QCameraUI
+    """
+
+    imageDataReady  = pyqtSignal(np.ndarray)                                       # display image
+    deliverRequest  = pyqtSignal()                                                 # latest image is in back buffer
+
+    def __init__(self, parent=None, displayfps: float = 50.):
+        super(QDisplayTap, self).__init__(parent)
+
+        self.interval   = 1./displayfps                                            # minimum time between displayed images
+        self.lock       = threading.Lock()
+        self.front      = None                                                     # image given to GUI
+        self.back       = None                                                     # latest image from processing
+        self.pending    = False                                                    # delivery is in GUI event queue
+        self.stats      = None                                                     # stageStatistics, None = not timed
+        self._last_time = 0.
+
+        self.deliverRequest.connect(self.on_deliver, Qt.QueuedConnection)
+
+    def due(self):
+        """ Enough time elapsed since last image, runs in processing thread """
+        return (time.perf_counter() - self._last_time) >= self.interval
+
+    def put(self, image):
+        """ Hand over latest display image, runs in processing thread """
+        self._last_time = time.perf_counter()
+        with self.lock:
+            if self.back is None or self.back.shape != image.shape or self.back.dtype != image.dtype:
+                self.back  = np.empty_like(image)
+                self.front = np.empty_like(image)
+            np.copyto(self.back, image)
+            if self.pending: return                                                # GUI will pick up latest image
+            self.pending = True
+        self.deliverRequest.emit()
+
+    @pyqtSlot()
+    def on_deliver(self):
+        """ Swap buffers and forward latest image, runs in GUI thread """
+        start_time = time.perf_counter()
+        with self.lock:
+            (self.front, self.back) = (self.back, self.front)
+            self.pending = False
+            put_time = self._last_time
+        self.imageDataReady.emit(self.front)                                       # direct connection, UI renders now
+        if self.stats is not None:
+            self.stats.record('delivery', start_time - put_time)
+            self.stats.record('render', time.perf_counter() - start_time)
+
+###############################################################################
+# Process Pool
+# Worker processes attach to the shared memory ring buffer of the data cube and
+# to a shared output ring buffer. Only slot index, background location and 
+# processing settings are sent to the workers, cube data is never pickled.
+###############################################################################
+
+_pool = {}                                                                          # shared arrays in worker process
+
+def _poolInit(cube_name, cube_shape, cube_dtype, ff_name, ff_shape, out_name, out_size):
+    """ Attach worker process to shared memory blocks """
+    for key, name in (('cube_shm', cube_name), ('ff_shm', ff_name), ('out_shm', out_name)):
+        _pool[key] = shared_memory.SharedMemory(name=name)
+    _pool['cubes'] = np.ndarray(cube_shape, cube_dtype, buffer=_pool['cube_shm'].buf)
+    _pool['ff']    = np.ndarray(ff_shape, 'uint16', buffer=_pool['ff_shm'].buf)
+    _pool['out']   = _pool['out_shm'].buf
+    _pool['size']  = out_size                                                       # bytes per slot in output ring buffer
+
+def _poolProcess(slot, start, shift, by, bx, background, flatfield, ff_bits, out_shape, out_dtype):
+    """ Background removal, flatfield correction and binning of cube in slot, runs in worker process """
+    cube = _pool['cubes'][slot]
+    out  = np.ndarray(out_shape, out_dtype, buffer=_pool['out'], offset=slot*_pool['size'])
+    if by == 1 and bx == 1:
+        depth = cube.shape[0]
+        if cube.dtype == np.uint8: _bgflat = QDataCube.bgflat8
+        else:                      _bgflat = QDataCube.bgflat16
+        bg = cube[start] if background else cube.dtype.type(0)
+        for i in range(depth):
+            _bgflat(cube[(start + i) % depth], bg, _pool['ff'][i] if flatfield else np.uint16(1 << ff_bits), shift, out=out[i])
+    else:
+        QDataCube.bgflatbinKernel(cube, start, _pool['ff'], by, bx, shift, background, flatfield, ff_bits, out)
+    return slot
+
+class cubeProcessPool():
+    """
+    Pool of worker processes for data cubes in shared memory
+    Results are written to shared output ring buffer with same slots as data cube,
+    result(slot) returns view of processed cube.
+    """
+
+    def __init__(self, datacube, processes: int = 4):
+
+        self.logger = logging.getLogger("QPool__")
+
+        self.datacube  = datacube
+        self.processes = processes
+        self.inflight  = 0                                                          # cubes submitted but not finished
+        self.lock      = threading.Lock()
+        # flatfield and output ring buffer in shared memory
+        # one output slot holds full resolution uint16 cube, binned cubes are smaller
+        (slots, depth, height, width) = datacube.cubes.shape
+        self.size      = depth*height*width*np.dtype('uint16').itemsize
+        self.ff_shm    = shared_memory.SharedMemory(create=True, size=datacube.ff.nbytes)
+        self.ff        = np.ndarray(datacube.ff.shape, 'uint16', buffer=self.ff_shm.buf)
+        self.ff[:]     = datacube.ff
+        self.out_shm   = shared_memory.SharedMemory(create=True, size=slots*self.size)
+        self.shapes    = [None]*slots                                               # shape and type of result in each slot
+        # spawn works on all platforms, workers import this module
+        self.pool = multiprocessing.get_context('spawn').Pool(processes, initializer=_poolInit, 
+            initargs=(datacube.shm.name, datacube.cubes.shape, datacube.cubes.dtype.str, self.ff_shm.name, self.ff.shape, self.out_shm.name, self.size))
+        self.logger.log(logging.INFO, "Status:Started {} worker processes.".format(processes))
+
+    @property
+    def busy(self):
+        """ all worker processes have a cube """
+        return self.inflight >= self.processes
+
+    def submit(self, slot, binning, background, flatfield, callback):
+        """ Process cube in slot, callback(slot, success) is called in result thread of pool when done """
+        (by, bx) = binning
+        if by == 1 and bx == 1:
+            shape, dtype = (self.datacube.depth, self.datacube.height, self.datacube.width), np.dtype('uint16')
+        else:
+            shape, dtype = (self.datacube.depth, self.datacube.height//by, self.datacube.width//bx), np.dtype(QDataCube.binDtype(16, by, bx))
+        self.shapes[slot] = (shape, dtype)
+        with self.lock:
+            self.inflight += 1
+        def _done(slot, success=True):
+            with self.lock:
+                self.inflight -= 1
+            callback(slot, success)
+        def _error(e):
+            self.logger.log(logging.ERROR, "Status:Processing of slot {} failed: {}".format(slot, e))
+            _done(slot, False)
+        self.pool.apply_async(_poolProcess, (slot, int(self.datacube.slot_start[slot]), self.datacube.shift, by, bx,
+                                             background, flatfield, self.datacube.ff_bits, shape, dtype.str),
+                              callback=_done, error_callback=_error)
+
+    def result(self, slot):
+        """ View of processed cube in slot """
+        (shape, dtype) = self.shapes[slot]
+        return np.ndarray(shape, dtype, buffer=self.out_shm.buf, offset=slot*self.size)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        for shm in (self.ff_shm, self.out_shm):
+            shm.close()
+            shm.unlink()
+
+class QDataCube(QObject):
     """ 
     Data Cube Class
-      initialize  create datacube
-      add(image)  add image to stack, when full emit signal and start at beginning again
-      sort()      sort so that lowest intensity is first image in stack
-      bgflat()    subtract background, multiply flatfield
-      bin2        binning 2x2 (explicit code is faster than general binning with slicing and summing in numpy)
-      bin3        binning 3x3
-      bin4        binning 4x4
-      bin5        binning 5x5
-      bin6        binning 6x6
-      bin9        binning 9x9
-      bin10       binning 10x10
-      bin12       binning 12x12
-      bin15       binning 15x15
-      bin18       binning 18x18
-      bin20       binning 20x20
+      initialize  create ring buffer of data cubes
+      add(image)  add image to cube in current slot, when full emit signal and continue with next free slot
+      acquire()   consumer claims a complete cube
+      release()   consumer returns cube to ring buffer
+      sort()      find lowest intensity image and make it logical start of stack
+      order()     physical location of images in sorted order
+      channel()   view of sorted image
+      bgflat()    subtract background (saturating), multiply fixed point flatfield, output uint16 in sorted order
+      bgflatbin() subtract background, multiply flatfield and bin in one pass, output in sorted order
+      binKernel   binning by x bx into caller provided output (explicit loops are faster than slicing and summing in numpy)
+      binDtype    output type for binning that does not overflow
+
+    Ring Buffer
+      Data cubes are preallocated in slots (slots, depth, height, width).
+      Each slot is EMPTY, FILLING, READY or PROCESSING.
+      Capture fills one slot, when complete it is marked READY and its index is emitted.
+      Consumer calls acquire(slot) which marks it PROCESSING and release(slot) when done.
+      Capture only moves on to EMPTY slots, if none is available the completed cube is 
+      dropped and the slot is filled again. Capture never allocates memory and never 
+      overwrites a cube that was not released by the consumer.
+
+    Shared Memory
+      With shared=True the ring buffer is allocated in multiprocessing shared memory 
+      so that cubeProcessPool worker processes can attach to it, close() frees it.
+
+    Background Detection (autosort)
+      add() records subsampled intensity of each image as it arrives, the background 
+      (darkest image) is known when the cube is complete and becomes its logical start.
+      If the background is found at the same location for lock_cycles cubes, the phase 
+      is locked and the intensity scan is skipped. Every verify_cycles cubes the 
+      phase is verified with a scan, if it changed the lock is released.
+      While locked, images are written rotated by the phase so that the background is
+      at location 0 and the slot is in sorted order, raw consumers can use it without copy.
+      Capture calls skip() when an image is lost, the partial cube is dropped and the lock is released.
+
+    Statistics
+      stats records latency of copying each image (capture), time to fill a cube (assembly)
+      and background detection (sort).
 
     Signals  
-        dataCubeReady    
+        dataCubeReady(slot)
         = For processWorker
         NEED TO DEVELOP
     Slots
       on_changeBinning
     """
 
-    dataCubeReady = pyqtSignal(np.ndarray)                                          # we have a complete datacube
+    dataCubeReady = pyqtSignal(int)                                                 # we have a complete datacube in slot
     
-    def __init__(self, parent=None, width=720, height=540, depth=14, flatfield = None):
+    def __init__(self, parent=None, width=720, height=540, depth=14, flatfield = None, slots = 4, dtype = 'uint8', bits = None, ff_bits = 8,
+                 autosort = True, delta: tuple = (64,64), lock_cycles = 3, verify_cycles = 35, shared = False):
         super(QDataCube, self).__init__(parent)
 
         self.logger = logging.getLogger("QDataC_")           
@@ -65,301 +953,432 @@ class QDataCube():
         self.width     = width
         self.height    = height
         self.depth     = depth
-        self.data      = np.zeros((depth, height, width), 'uint8')                   # allocate space for the data cube images
-        self.bg        = np.zeros((height, width), 'uint8')                          # allocate space for background image
-        self.flat      = 256*np.ones((depth, height, width), 'uint16')               # flatfield correction image, scaled so that 255=100%
+        if shared:                                                                   # ring buffer in shared memory for process pool
+            self.shm   = shared_memory.SharedMemory(create=True, size=slots*depth*height*width*np.dtype(dtype).itemsize)
+            self.cubes = np.ndarray((slots, depth, height, width), dtype, buffer=self.shm.buf)
+            self.cubes[:] = 0
+        else:
+            self.shm   = None
+            self.cubes = np.zeros((slots, depth, height, width), dtype)             # allocate space for all data cubes in ring buffer, uint8 or uint16
+        self.bg        = np.zeros((height, width), dtype)                            # allocate space for background image
+        self.bits      = bits if bits is not None else 8*np.dtype(dtype).itemsize   # bit depth of camera data
+        self.ff_bits   = ff_bits                                                     # fractional bits of fixed point flatfield
+        self.shift     = self.bgflatShift(self.bits, ff_bits)                        # right shift after flatfield so that result fits 16 bits
+        self.flat      = (1 << ff_bits)*np.ones((depth, height, width), 'uint16')    # flatfield correction image, scaled so that 256=100% for 8 fractional bits
         self.inten     = np.zeros(depth, 'uint16')                                   # average intentisy in each image of the stack
         self.data_indx = 0                                                           # current location to fill the data cube with new image
+        self._fill_offset = 0                                                        # locked background phase when current cube was started
+
+        # Ring buffer
+        self.slot_state = np.full(slots, SLOT_EMPTY, 'uint8')                        # state of each slot
+        self.slot_seq   = np.zeros(slots, 'int64')                                   # cube number stored in each slot
+        self.slot_start = np.zeros(slots, 'int64')                                   # logical start of each cube, location of background image
+        self.slot_time  = np.zeros(slots, 'float64')                                 # perf_counter when cube was completed
+        self.rotations  = (np.arange(depth)[None,:] + np.arange(depth)[:,None]) % depth # image order for each possible start
+        self.slot_lock  = threading.Lock()                                           # capture and consumer change slot states
+        self.slot_fill  = 0                                                          # slot currently filled by capture
+        self.slot_state[self.slot_fill] = SLOT_FILLING
+        self.cube_count = 0                                                          # number of completed cubes
+        self._dropped   = 0                                                          # number of cubes dropped because no slot was free
+
+        # Background detection
+        self.autosort      = autosort                                                # find background while acquiring
+        self.bg_delta      = delta                                                   # intensity subsampling intervals y,x
+        self.lock_cycles   = lock_cycles                                             # cubes with same background location to lock phase
+        self.verify_cycles = verify_cycles                                           # verify locked phase every so many cubes
+        self.slot_inten    = np.zeros((slots, depth), 'uint32')                      # subsampled intensity of each image in each slot
+        self.bg_phase      = -1                                                      # locked background location, -1 = not locked
+        self.bg_candidate  = -1                                                      # background location of last scanned cube
+        self.bg_count      = 0                                                       # number of cubes background was at candidate location
+        self.bg_cycles     = 0                                                       # number of cubes since phase was locked
+        self._scan         = autosort                                                # measure intensity of images in current cube
+
+        # Display mosaic
+        self._layout       = None                                                    # tile locations, size and labels
+        self._layout_key   = None                                                    # selection and display size of layout
+
+        # Statistics
+        self.stats         = stageStatistics()                                       # capture, assembly and sort latency
+        self._cube_start   = time.perf_counter()                                     # first image of current cube arrived
 
         if flatfield is None:
             self.logger.log(logging.ERROR, "Status:Need to provide flatfield!")
-            return False
+            self.ff = self.flat
         else: 
             self.ff = flatfield
 
+    def close(self):
+        """ Free shared memory of ring buffer """
+        if self.shm is not None:
+            self.cubes = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    @property
+    def slots(self):
+        """ number of data cubes in ring buffer """
+        return self.cubes.shape[0]
+
+    @property
+    def dropped(self):
+        """ number of completed data cubes that were dropped because all slots were in use """
+        return self._dropped
+
     # need functions to collect images into data cube and sort it
     def add(self, image):
-        self.data[self.data_indx,:,:] = image
+        """ 
+        Copy image into data cube. 
+        Image can be a view of the camera driver buffer, it is copied once into the slot 
+        without temporary allocation, the driver buffer can be released afterwards.
+        """
+        start_time = time.perf_counter()
+        if self.data_indx == 0:
+            self._cube_start  = start_time
+            self._fill_offset = max(self.bg_phase, 0)                                # background of locked phase goes to location 0
+        location = (self.data_indx - self._fill_offset) % self.depth
+        np.copyto(self.cubes[self.slot_fill, location,:,:], image, casting='same_kind')
+        if self._scan:
+            self.slot_inten[self.slot_fill, self.data_indx] = np.sum(self.cubes[self.slot_fill, location, ::self.bg_delta[0], ::self.bg_delta[1]], dtype='uint32')
         self.data_indx += 1
+        self.stats.record('capture', time.perf_counter() - start_time)
         if self.data_indx >= self.depth:
-            self.dataCubeReady.emit(self.data)
             self.data_indx = 0
+            self._cubeComplete()
 
-    def sort(self, delta: tuple = (64,64)):
-        """ Sorts data cube so that first image is the one with lowest intensity (background) """
+    def skip(self):
+        """
+        Camera lost an image, the image sequence is shifted by one.
+        Partial cube is dropped and the background phase lock is released,
+        the next cube is scanned for the background.
+        """
+        self.data_indx    = 0
+        self.bg_phase     = -1
+        self.bg_candidate = -1
+        self.bg_count     = 0
+        self._scan        = self.autosort
+        self.logger.log(logging.WARNING, "Status:Image lost, background phase released.")
+
+    def _cubeComplete(self):
+        """ Hand completed cube to consumer and move on to next free slot """
+        start_time = time.perf_counter()
+        self.stats.record('assembly', start_time - self._cube_start)
+        if self.autosort:
+            self._detectBackground(self.slot_fill)
+            self.stats.record('sort', time.perf_counter() - start_time)
+        with self.slot_lock:
+            slot = self._nextEmptySlot()
+            if slot < 0:
+                # no free slot, overwrite the cube we just completed
+                self._dropped += 1
+                return
+            done = self.slot_fill
+            self.slot_state[done] = SLOT_READY
+            self.slot_seq[done]   = self.cube_count
+            self.slot_time[done]  = start_time
+            self.cube_count      += 1
+            self.slot_state[slot] = SLOT_FILLING
+            self.slot_start[slot] = 0
+            self.slot_fill        = slot
+        self.dataCubeReady.emit(done)
+
+    def _detectBackground(self, slot):
+        """
+        Set logical start of cube in slot to background image, lock on to stable phase
+        Phase is counted in images since start of cube, slot_start is location in rotated slot
+        """
+        if self._scan:
+            bg = int(np.argmin(self.slot_inten[slot]))
+            if bg == self.bg_candidate:
+                self.bg_count += 1
+            else:
+                self.bg_candidate = bg
+                self.bg_count     = 1
+            if self.bg_phase >= 0 and bg != self.bg_phase:
+                self.bg_phase = -1
+                self.logger.log(logging.WARNING, "Status:Background phase lost, now at {}.".format(bg))
+            elif self.bg_phase < 0 and self.bg_count >= self.lock_cycles:
+                self.bg_phase  = bg
+                self.bg_cycles = 0
+                self.logger.log(logging.INFO, "Status:Background phase locked at {}.".format(bg))
+            self.slot_start[slot] = (bg - self._fill_offset) % self.depth
+        else:
+            self.slot_start[slot] = (self.bg_phase - self._fill_offset) % self.depth
+        # scan next cube if not locked or if locked phase needs verification
+        self.bg_cycles += 1
+        self._scan = (self.bg_phase < 0) or (self.bg_cycles % self.verify_cycles == 0)
+
+    def _nextEmptySlot(self):
+        """ Search ring buffer for next empty slot after the one being filled, -1 if none """
+        slots = self.slots
+        for i in range(1, slots):
+            slot = (self.slot_fill + i) % slots
+            if self.slot_state[slot] == SLOT_EMPTY:
+                return slot
+        return -1
+
+    def acquire(self, slot):
+        """ Consumer claims completed cube in slot, returns None if cube is not ready """
+        with self.slot_lock:
+            if self.slot_state[slot] != SLOT_READY:
+                return None
+            self.slot_state[slot] = SLOT_PROCESSING
+        return self.cubes[slot]
+
+    def release(self, slot):
+        """ Consumer is done with cube in slot, capture may reuse it """
+        with self.slot_lock:
+            if self.slot_state[slot] == SLOT_PROCESSING:
+                self.slot_state[slot] = SLOT_EMPTY
+
+    def sort(self, slot, delta: tuple = (64,64)):
+        """ 
+        Sorts data cube in slot so that first image is the one with lowest intensity (background) 
+        Pixel data is not moved, the logical start of the cube is set to the background image.
+        Use channel() or order() to access the images in sorted order.
+        """
         # create intensity reading for each image in the stack
         bg_dx = delta[1]                                    # take intensity values at delta x intervals
         bg_dy = delta[0]                                    # take intensity values at delta y intervals
-        (depth, width, height) = self.data.shape  
-        self.inten = np.sum(self.data[:,::bg_dx,::bg_dy], axis=(1,2)) # intensities at selected points in image
-        # create sorting index        
-        background_indx = np.argmin(self.inten)             # lowest itensity
-        indx  = np.arange(0, depth)                         # 0..depth-1
-        indx  = indx + background_indx + 1                  # index shifted
-        indx  = indx%depth                                  # now bg is at first location in indx
-        # data sorted
-        self.data = self.data[indx,:,:]                     # rearrange data cube
+        self.inten = np.sum(self.cubes[slot,:,::bg_dy,::bg_dx], axis=(1,2)) # intensities at selected points in image
+        # background is logical start of cube
+        self.slot_start[slot] = np.argmin(self.inten)       # lowest itensity
+
+    def order(self, slot):
+        """ Physical location of the images in slot in sorted order, background first """
+        return self.rotations[self.slot_start[slot]]
+
+    def channel(self, slot, i):
+        """ View of sorted image i in slot, 0 is background """
+        return self.cubes[slot, (self.slot_start[slot] + i) % self.depth]
+
+    def bgflat(self, slot, out, background: bool = True, flatfield: bool = True):
+        """
+        Subtract background and apply flatfield to cube in slot
+        Result is written to out (uint16) in sorted order, background first
+        background and flatfield False pass scalars instead, no background or flatfield image is read
+        """
+        if self.cubes.dtype == np.uint8: _bgflat = QDataCube.bgflat8
+        else:                            _bgflat = QDataCube.bgflat16
+        bg = self.channel(slot, 0) if background else self.cubes.dtype.type(0)
+        for i in range(self.depth):
+            ff = self.ff[i] if flatfield else np.uint16(1 << self.ff_bits)         # unity flatfield
+            _bgflat(self.channel(slot, i), bg, ff, self.shift, out=out[i])
+        return out
     
-    def cube2DisplayImage(self, displayImage, indx=[0], name=[]):
-        """ 
-        Flattens the data cube to a display image.
-        If 3 channels are selected, this requires 2x2 tile. 
-        It will add channel label to the image tiles. 
-        indx is selected channels
-        name is the channel names with same length as indx
+    def bgflatbin(self, slot, binning, out, background: bool = True, flatfield: bool = True):
         """
-        
+        Subtract background, apply flatfield and bin cube in slot in one pass
+        binning is (vertical, horizontal)
+        Result is written to out (depth, height//binning[0], width//binning[1]) in sorted order
+        """
+        QDataCube.bgflatbinKernel(self.cubes[slot], self.slot_start[slot], self.ff, binning[0], binning[1], self.shift,
+                                  background, flatfield, self.ff_bits, out)
+        return out
+
+    def _mosaicLayout(self, displayImage, indx, name):
+        """
+        Tile locations, tile size and rendered labels for display mosaic.
+        Computed only when channel selection, names or display size change.
+        """
+        key = (tuple(indx), tuple(name), displayImage.shape)
+        if key == self._layout_key:
+            return self._layout
+
         font             = cv2.FONT_HERSHEY_SIMPLEX
         fontScale        = 1
         lineType         = 2
-        
-        (depth,height,width) = self.data.shape
-        # if len(indx) == depth:
-        # maybe faster option if all images are selected
-        # 
-        
+
         # arrange selected images in a grid
         columns = math.ceil(math.sqrt(len(indx))) # how many columns are needed?
-        rows   = math.ceil(len(indx)/columns)     # how many rows are needed?
-        empty  = np.zeros((height,width), dtype=_htmp.dtype)
-        i = 0
-        for y in range(rows):
-            _htmp = self.data[indx[i],:,:]
-            for x in range(columns-1):
-                if i < len(indx):
-                    _htmp=cv2.hconcat((_htmp,self.data[indx[i+1],:,:]))
-                else:
-                    _htmp=cv2.hconcat((_htmp,empty))
-                i +=1
-            if y == 0:
-                _vtmp = _htmp
+        rows    = math.ceil(len(indx)/columns)    # how many rows are needed?
+        # scale grid of images to fit into display image
+        (newHeight, newWidth) = displayImage.shape[:2]
+        scale = min(newHeight/(rows*self.height), newWidth/(columns*self.width))
+        dsize = (int(self.width*scale), int(self.height*scale))                      # tile width, height
+        tiles = [((i // columns)*dsize[1], (i % columns)*dsize[0]) for i in range(len(indx))]
+
+        # render labels once, white box with black text
+        labels = []
+        for i in range(len(name)):
+            (Label_width, Label_height), BaseLine = cv2.getTextSize(name[i], fontFace=font, fontScale=fontScale, thickness=lineType)
+            h = Label_height + BaseLine
+            label = np.full((h, Label_width), 255, dtype='uint8')
+            cv2.putText(label, text=name[i], org=(0, Label_height), fontFace=font, fontScale=fontScale, color=0, thickness=lineType)
+            labels.append(label[:dsize[1], :dsize[0]])                               # label can not be larger than tile
+
+        displayImage[:] = 0                                                          # area not covered by tiles
+        self._layout = {
+            "tiles"  : tiles,                                                        # top left corner (y, x) of each tile
+            "dsize"  : dsize,                                                        # tile width, height
+            "labels" : labels,
+            "tmp"    : None if self.cubes.dtype == np.uint8 else np.empty((dsize[1], dsize[0]), self.cubes.dtype) }
+        self._layout_key = key
+        return self._layout
+
+    def cube2DisplayImage(self, slot, displayImage, indx=[0], name=[]):
+        """ 
+        Flattens the data cube in slot to a display image.
+        If 3 channels are selected, this requires 2x2 tile. 
+        It will add channel label to the image tiles. 
+        displayImage is 8bit height x width, it is displayed through a color table
+        indx is selected channels
+        name is the channel names with same length as indx
+        Layout is cached, each image is resized straight into its tile of the display image.
+        16bit data is shifted to 8bit.
+        """
+        layout = self._mosaicLayout(displayImage, indx, name)
+        (tw, th) = layout["dsize"]
+        for i in range(len(indx)):
+            (y, x) = layout["tiles"][i]
+            tile = displayImage[y:y+th, x:x+tw]
+            if layout["tmp"] is None:
+                cv2.resize(self.channel(slot, indx[i]), (tw, th), dst=tile, interpolation=cv2.INTER_LINEAR)
             else:
-                _vtmp=cv2.vconcat((_vtmp,_htmp))
+                cv2.resize(self.channel(slot, indx[i]), (tw, th), dst=layout["tmp"], interpolation=cv2.INTER_LINEAR)
+                np.right_shift(layout["tmp"], self.bits - 8, out=tile, casting='unsafe')
+            if i < len(layout["labels"]):
+                label = layout["labels"][i]
+                tile[:label.shape[0], :label.shape[1]] = label
+
+    def cube2ColorImage(self, slot, colorImage, indx=[1,2,3], luts=None):
+        """
+        Pseudo color composite of the data cube in slot.
+        indx are red, green and blue channels in sorted cube,
+        luts (3 x 2**bits uint8) map background removed data to red, green and blue,
+        they include gain, offset and gamma (see colorLUT).
+        colorImage is 8bit height x width x 3 in BGR order, image is scaled to fit with
+        nearest neighbour sampling, integer operations only.
+        """
+        (newHeight, newWidth) = colorImage.shape[:2]
+        scale = min(newHeight/self.height, newWidth/self.width)
+        tile  = colorImage[:int(self.height*scale), :int(self.width*scale)]
+        QDataCube.colorKernel(self.channel(slot, indx[0]), self.channel(slot, indx[1]), self.channel(slot, indx[2]),
+                              self.channel(slot, 0), luts, tile)
+
+    @staticmethod
+    def colorLUT(bits, gain = 1., offset = 0., gamma = 1.):
+        """
+        Lookup table from background removed bits bit data to 8 bit display value
+        out = 255 * (gain * (data - offset) / (2**bits - 1)) ** (1/gamma), clipped to 0..255
+        """
+        x = (np.arange(2**bits, dtype='float64') - offset) * gain / (2**bits - 1)
+        return np.rint(255. * np.clip(x, 0., 1.) ** (1./gamma)).astype('uint8')
+
+    # Pseudo color composite
+    # Background removal with clamped integer subtraction, then lookup of display value
+    # Nearest neighbour sampling to display resolution
+    @jit(nopython=True, fastmath=True, parallel=True, cache=True)
+    def colorKernel(red, green, blue, background, luts, out):
+        """Background removal and lookup of red, green and blue into BGR image """
+        height, width = red.shape
+        ho, wo = out.shape[0], out.shape[1]
+        for yo in prange(ho):
+            y = (yo * height) // ho
+            for xo in range(wo):
+                x  = (xo * width) // wo
+                bg = background[y,x]
+                b  = blue[y,x];  out[yo,xo,0] = luts[2, b - bg] if b > bg else luts[2, 0]
+                g  = green[y,x]; out[yo,xo,1] = luts[1, g - bg] if g > bg else luts[1, 0]
+                r  = red[y,x];   out[yo,xo,2] = luts[0, r - bg] if r > bg else luts[0, 0]
 
-        # resize grid of images to fit into display image
-        (height, width) = _vtmp.shape[:2]
-        (newHeight, newWidth) = displayImage.shape[:2]
-        scale = max(height/newHeight, width/newWidth)
-        dsize = (int(width // scale), int(height // scale))
-        img = cv2.resize(_vtmp, dsize, cv2.INTER_LINEAR)
-        (height, width) = img.shape[:2]
-        # copy grid image into display image: display image has 3 channels        
-        displayImage[0:height,0:width,0] = img
-        displayImage[0:height,0:width,1] = img
-        displayImage[0:height,0:width,2] = img
-        if len(name) > 0:
-            # add text to the individual images
-            x = y = 0
-            dx = width / columns
-            dy = height / rows
-            for i in indx:
-                (Label_width, Label_height), BaseLine = cv2.getTextSize(name[i], fontFace=font, fontScale=fontScale, thickness=lineType)
-                h = Label_height + BaseLine
-                loc_x = int(x * dx)
-                loc_y = int(y * dy + h)
-                cv2.rectangle(displayImage,
-                    (loc_x, loc_y),
-                    (loc_x + Label_width, loc_y + h),
-                    (255,255,255), -1, )
-                cv2.putText(displayImage, 
-                    text=name[i], 
-                    org=(loc_x, loc_y), 
-                    fontFace=font, 
-                    fontScale=fontScale, 
-                    color=(0,0,0), 
-                    thickness=lineType)
-                # update location
-                x += 1
-                if x >= columns-1: 
-                    x=0
-                    y+=1
-
-                
     # Faltfield Correction and Background removal
-    #            result stack  bg     ff
-    @vectorize(['uint16(uint8, uint8, uint16)'], nopython=True, fastmath=True, cache=True)
-    def bgflat8(data_cube, background, flatfield):
+    # Saturating: pixels darker than background are 0, result is clipped to 65535
+    # Flatfield is fixed point with ff_bits fractional bits (256 = 100% for 8 bits),
+    # subtraction result is multiplied in 32 bits and shifted right by shift
+    #            result  stack  bg     ff      shift
+    @vectorize(['uint16(uint8,  uint8, uint16, uint8)'], nopython=True, fastmath=True, cache=True)
+    def bgflat8(data_cube, background, flatfield, shift):
         """Background removal, flat field correction, white balance """
-        return np.multiply(np.subtract(data_cube, background), flatfield) # 8bit subtraction, 16bit multiplication
+        if data_cube <= background: return 0                                         # clamped 8bit subtraction
+        v = (np.uint32(data_cube - background) * np.uint32(flatfield)) >> shift      # 32bit multiplication
+        if v > 65535: return 65535
+        return v
 
     # Faltfield Correction and Background removal
-    #            result stack  bg     ff
-    @vectorize(['uint32(uint16, uint16, uint16)'], nopython=True, fastmath=True, cache=True)
-    def bgflat16(data_cube, background, flatfield):
+    #            result  stack   bg      ff      shift
+    @vectorize(['uint16(uint16, uint16, uint16, uint8)'], nopython=True, fastmath=True, cache=True)
+    def bgflat16(data_cube, background, flatfield, shift):
         """Background removal, flat field correction, white balance """
-        return np.multiply(np.subtract(data_cube, background), flatfield) # 8bit subtraction, 16bit multiplication
-
-    # General purpose binning, this is 3 times slower compared to the routines below
-    # @jit(nopython=True, fastmath=True, cache=True)
-    # def rebin(arr, bin_x, bin_y, dtype=np.uint16):
-    #     # https://stackoverflow.com/questions/36063658/how-to-bin-a-2d-array-in-numpy
-    #     m,n,o = np.shape(arr)
-    #     shape = (m//bin_x, bin_x, n//bin_y, bin_y, o)
-    #     arr_ = arr.astype(dtype)
-    #     return arr_.reshape(shape).sum(3).sum(1)
-
-    # Binning 2 pixels of the 8bit images
-    @jit(nopython=True, fastmath=True, parallel=True, cache=True)
-    def bin2(arr_in):
-        m,n,o   = np.shape(arr_in)
-        arr_tmp = np.empty((m//2,n,o), dtype='uint16')
-        arr_out = np.empty((m//2,n//2,o), dtype='uint16')
-        for i in prange(m//2):
-            arr_tmp[i,:,:] =  arr_in[i*2,:,:] +  arr_in[i*2+1,:,:]
-        for j in prange(n//2):
-            arr_out[:,j,:] = arr_tmp[:,j*2,:] + arr_tmp[:,j*2+1,:] 
-        return arr_out
-
-    # Binning 3 pixels of the 8bit images
-    @jit(nopython=True, fastmath=True, parallel=True, cache=True)
-    def bin3(arr_in):
-        m,n,o   = np.shape(arr_in)
-        arr_tmp = np.empty((m//3,n,o), dtype='uint16')
-        arr_out = np.empty((m//3,n//3,o), dtype='uint16')
-        for i in prange(m//3):
-            arr_tmp[i,:,:] =  arr_in[i*3,:,:] +  arr_in[i*3+1,:,:] +  arr_in[i*3+2,:,:] 
-        for j in prange(n//3):
-            arr_out[:,j,:] = arr_tmp[:,j*3,:] + arr_tmp[:,j*3+1,:] + arr_tmp[:,j*3+2,:] 
-        return arr_out
-
-    # Binning 4 pixels of the 8bit images
-    @jit(nopython=True, fastmath=True, parallel=True, cache=True)
-    def bin4(arr_in):
-        m,n,o   = np.shape(arr_in)
-        arr_tmp = np.empty((m//4,n,o), dtype='uint16')
-        arr_out = np.empty((m//4,n//4,o), dtype='uint16')
-        for i in prange(m//4):
-            arr_tmp[i,:,:] =  arr_in[i*4,:,:] +  arr_in[i*4+1,:,:] +  arr_in[i*4+2,:,:] +  arr_in[i*4+3,:,:]
-        for j in prange(n//4):
-            arr_out[:,j,:] = arr_tmp[:,j*4,:] + arr_tmp[:,j*4+1,:] + arr_tmp[:,j*4+2,:] + arr_tmp[:,j*4+3,:]
-        return arr_out
-
-    # Binning 5 pixels of the 8bit images
+        if data_cube <= background: return 0                                         # clamped 16bit subtraction
+        v = (np.uint32(data_cube - background) * np.uint32(flatfield)) >> shift      # 32bit multiplication
+        if v > 65535: return 65535
+        return v
+
+    @staticmethod
+    def bgflatShift(bits, ff_bits = 8):
+        """Right shift after flatfield multiplication so that bits bit data with 100% flatfield fits into 16 bits """
+        return max(0, bits + ff_bits - 16)
+
+    @staticmethod
+    def flatfieldFixedPoint(flatfield, ff_bits = 8):
+        """Convert floating point flatfield (1.0 = 100%) to uint16 fixed point with ff_bits fractional bits """
+        return np.clip(np.rint(flatfield * (1 << ff_bits)), 0, 65535).astype('uint16')
+
+    # Fused background removal, flatfield correction and binning
+    # One sweep over the raw cube, no intermediate cubes are written.
+    # Numba compiles one kernel for uint8 and one for uint16 cubes.
+    # cube is in acquisition order, start is location of background image, 
+    # flatfield and result are in sorted order, background first.
+    # Sum of bin is shifted right by shift.
+    # out needs to be (depth, height//by, width//bx), 
+    # with shift from bgflatShift binDtype(16, by, bx) is sufficient
+    # Without subtract the background is not read, without multiply the flatfield
+    # is not read and the sum is scaled by unity flatfield 1 << ff_bits.
     @jit(nopython=True, fastmath=True, parallel=True, cache=True)
-    def bin5(arr_in):
-        m,n,o   = np.shape(arr_in)
-        arr_tmp = np.empty((m//5,n,o), dtype='uint16')
-        arr_out = np.empty((m//5,n//5,o), dtype='uint16')
-        for i in prange(m//5):
-            arr_tmp[i,:,:] =  arr_in[i*5,:,:] +  arr_in[i*5+1,:,:] +  arr_in[i*5+2,:,:] +  arr_in[i*5+3,:,:] +  arr_in[i*5+4,:,:]
-        for j in prange(n//5):
-            arr_out[:,j,:] = arr_tmp[:,j*5,:] + arr_tmp[:,j*5+1,:] + arr_tmp[:,j*5+2,:] + arr_tmp[:,j*5+3,:] + arr_tmp[:,j*5+4,:] 
-        return arr_out
-
-    # Binning 6 pixels of the 8bit images
+    def bgflatbinKernel(cube, start, flatfield, by, bx, shift, subtract, multiply, ff_bits, out):
+        """Background removal (if subtract), flat field correction (if multiply) and by x bx binning """
+        depth, height, width = cube.shape
+        ho = height // by
+        wo = width  // bx
+        for k in prange(depth*ho):                           # channels and output rows in parallel
+            c = k // ho                                      # sorted channel
+            y = k %  ho                                      # output row
+            p = (start + c) % depth                          # location of channel in cube
+            for x in range(wo):
+                acc = np.uint64(0)
+                for dy in range(by):
+                    yy = y*by + dy
+                    for dx in range(bx):
+                        xx = x*bx + dx
+                        d = np.int64(cube[p,yy,xx])
+                        if subtract: d -= np.int64(cube[start,yy,xx])
+                        if d > 0:                            # darker than background is zero
+                            if multiply: acc += np.uint64(d) * np.uint64(flatfield[c,yy,xx])
+                            else:        acc += np.uint64(d)
+                if not multiply: acc = acc << ff_bits
+                out[c,y,x] = acc >> shift
+
+    # General purpose binning
+    # Sums by x bx blocks of each image of (depth, height, width) array into out (depth, height//by, width//bx).
+    # Channels and output rows run in parallel, no temporary arrays are allocated.
+    # Use binDtype to allocate out so that the sums do not overflow.
+    # This replaces the hand unrolled bin2..bin20 routines (archive/Binning_unrolled.py) and is at least as fast,
+    # run this file to benchmark.
     @jit(nopython=True, fastmath=True, parallel=True, cache=True)
-    def bin6(arr_in):
-        m,n,o   = np.shape(arr_in)
-        arr_tmp = np.empty((m//6,n,o), dtype='uint16')
-        arr_out = np.empty((m//6,n//6,o), dtype='uint16')
-        for i in prange(m//6):
-            arr_tmp[i,:,:] =  arr_in[i*6,:,:] +  arr_in[i*6+1,:,:] +  arr_in[i*6+2,:,:] +  arr_in[i*6+3,:,:] +  arr_in[i*6+4,:,:]  \
-                           +  arr_in[i*6+5,:,:]
-        for j in prange(n//6):
-            arr_out[:,j,:] = arr_tmp[:,j*6,:] + arr_tmp[:,j*6+1,:] + arr_tmp[:,j*6+2,:] + arr_tmp[:,j*6+3,:] + arr_tmp[:,j*6+4,:] \
-                           + arr_tmp[:,j*6+5,:]  
-        return arr_out
-
-    # Binning 9 pixels of the 8bit images
-    @jit(nopython=True, fastmath=True, parallel=True, cache=True)
-    def bin9(arr_in):
-        m,n,o   = np.shape(arr_in)
-        arr_tmp = np.empty((m//9,n,o), dtype='uint16')
-        arr_out = np.empty((m//9,n//9,o), dtype='uint16')
-        for i in prange(m//9):
-            arr_tmp[i,:,:] =  arr_in[i*9,:,:]   + arr_in[i*9+1,:,:]  + arr_in[i*9+2,:,:]  + arr_in[i*9+3,:,:]  +  arr_in[i*9+4,:,:] \
-                           +  arr_in[i*9+5,:,:] + arr_in[i*9+6,:,:]  + arr_in[i*9+7,:,:]  + arr_in[i*9+8,:,:] 
-        for j in prange(n//9):
-            arr_out[:,j,:] = arr_tmp[:,j*9,:]   + arr_tmp[:,j*9+1,:] + arr_tmp[:,j*9+2,:] + arr_tmp[:,j*9+3,:] + arr_tmp[:,j*9+4,:] \
-                           + arr_tmp[:,j*9+5,:] + arr_tmp[:,j*9+6,:] + arr_tmp[:,j*9+7,:] + arr_tmp[:,j*9+8,:]
-        return arr_out
-
-    # Binning 10 pixels of the 8bit images
-    @jit(nopython=True, fastmath=True, parallel=True, cache=True)
-    def bin10(arr_in):
-        m,n,o   = np.shape(arr_in)
-        arr_tmp = np.empty((m//10,n,o), dtype='uint16')
-        arr_out = np.empty((m//10,n//10,o), dtype='uint16')
-        for i in prange(m//10):
-            arr_tmp[i,:,:] =  arr_in[i*10,:,:]   + arr_in[i*10+1,:,:] +  arr_in[i*10+2,:,:] +  arr_in[i*10+3,:,:] +  arr_in[i*10+4,:,:] \
-                            + arr_in[i*10+5,:,:] + arr_in[i*10+6,:,:] +  arr_in[i*10+7,:,:] +  arr_in[i*10+8,:,:] +  arr_in[i*10+9,:,:]
-
-        for j in prange(n//10):
-            arr_out[:,j,:] = arr_tmp[:,j*10,:]   + arr_tmp[:,j*10+1,:] + arr_tmp[:,j*10+2,:] + arr_tmp[:,j*10+3,:] + arr_tmp[:,j*10+4,:] \
-                           + arr_tmp[:,j*10+5,:] + arr_tmp[:,j*10+6,:] + arr_tmp[:,j*10+7,:] + arr_tmp[:,j*10+8,:] + arr_tmp[:,j*10+9,:]
-        return arr_out
-
-    # Binning 12 pixels of the 8bit images
-    @jit(nopython=True, fastmath=True, parallel=True, cache=True)
-    def bin12(arr_in):
-        m,n,o   = np.shape(arr_in)
-        arr_tmp = np.empty((m//12,n,o), dtype='uint16')
-        arr_out = np.empty((m//12,n//12,o), dtype='uint32')
-        for i in prange(m//12):
-            arr_tmp[i,:,:] =  arr_in[i*12,:,:]    + arr_in[i*12+1,:,:]  + arr_in[i*12+2,:,:]  + arr_in[i*12+3,:,:]  + arr_in[i*12+4,:,:]  \
-                            + arr_in[i*12+5,:,:]  + arr_in[i*12+6,:,:]  + arr_in[i*12+7,:,:]  + arr_in[i*12+8,:,:]  + arr_in[i*12+9,:,:]  \
-                            + arr_in[i*12+10,:,:] + arr_in[i*12+11,:,:] 
-
-        for j in prange(n//12):
-            arr_out[:,j,:]  = arr_tmp[:,j*12,:]    + arr_tmp[:,j*12+1,:]  + arr_tmp[:,j*12+2,:] + arr_tmp[:,j*12+3,:] + arr_tmp[:,j*12+4,:] \
-                            + arr_tmp[:,j*12+5,:]  + arr_tmp[:,j*12+6,:]  + arr_tmp[:,j*12+7,:] + arr_tmp[:,j*12+8,:] + arr_tmp[:,j*12+9,:] \
-                            + arr_tmp[:,j*12+10,:] + arr_tmp[:,j*12+11,:] 
-        return arr_out
-
-    # Binning 15 pixels of the 8bit images
-    @jit(nopython=True, fastmath=True, parallel=True, cache=True)
-    def bin15(arr_in):
-        m,n,o   = np.shape(arr_in)
-        arr_tmp = np.empty((m//15,n,o), dtype='uint16')
-        arr_out = np.empty((m//15,n//15,o), dtype='uint32')
-        for i in prange(m//15):
-            arr_tmp[i,:,:] =  arr_in[i*15,:,:]    + arr_in[i*15+1,:,:]  + arr_in[i*15+2,:,:]  + arr_in[i*15+3,:,:]  + arr_in[i*15+4,:,:]  \
-                            + arr_in[i*15+5,:,:]  + arr_in[i*15+6,:,:]  + arr_in[i*15+7,:,:]  + arr_in[i*15+8,:,:]  + arr_in[i*15+9,:,:]  \
-                            + arr_in[i*15+10,:,:] + arr_in[i*15+11,:,:] + arr_in[i*15+12,:,:] + arr_in[i*15+13,:,:] + arr_in[i*15+14,:,:] 
-
-        for j in prange(n//15):
-            arr_out[:,j,:]  = arr_tmp[:,j*15,:]    + arr_tmp[:,j*15+1,:]  + arr_tmp[:,j*15+2,:]  + arr_tmp[:,j*15+3,:]  + arr_tmp[:,j*15+4,:]  \
-                            + arr_tmp[:,j*15+5,:]  + arr_tmp[:,j*15+6,:]  + arr_tmp[:,j*15+7,:]  + arr_tmp[:,j*15+8,:]  + arr_tmp[:,j*15+9,:]  \
-                            + arr_tmp[:,j*15+10,:] + arr_tmp[:,j*15+11,:] + arr_tmp[:,j*15+12,:] + arr_tmp[:,j*15+13,:] + arr_tmp[:,j*15+14,:]
-        return arr_out
-
-    # Binning 18 pixels of the 8bit images
-    @jit(nopython=True, fastmath=True, parallel=True, cache=True)
-    def bin18(arr_in):
-        m,n,o   = np.shape(arr_in)
-        arr_tmp = np.empty((m//18,n,o), dtype='uint16')
-        arr_out = np.empty((m//18,n//18,o), dtype='uint32')
-        for i in prange(m//18):
-            arr_tmp[i,:,:] =  arr_in[i*18,:,:]    + arr_in[i*18+1,:,:]  + arr_in[i*18+2,:,:]  + arr_in[i*18+3,:,:]  + arr_in[i*18+4,:,:]  \
-                            + arr_in[i*18+5,:,:]  + arr_in[i*18+6,:,:]  + arr_in[i*18+7,:,:]  + arr_in[i*18+8,:,:]  + arr_in[i*18+9,:,:]  \
-                            + arr_in[i*18+10,:,:] + arr_in[i*18+11,:,:] + arr_in[i*18+12,:,:] + arr_in[i*18+13,:,:] + arr_in[i*18+14,:,:] \
-                            + arr_in[i*18+15,:,:] + arr_in[i*18+16,:,:] + arr_in[i*18+17,:,:] 
-
-        for j in prange(n//18):
-            arr_out[:,j,:]  = arr_tmp[:,j*18,:]    + arr_tmp[:,j*18+1,:]  + arr_tmp[:,j*18+2,:]  + arr_tmp[:,j*18+3,:]  + arr_tmp[:,j*18+4,:]  \
-                            + arr_tmp[:,j*18+5,:]  + arr_tmp[:,j*18+6,:]  + arr_tmp[:,j*18+7,:]  + arr_tmp[:,j*18+8,:]  + arr_tmp[:,j*18+9,:]  \
-                            + arr_tmp[:,j*18+10,:] + arr_tmp[:,j*18+11,:] + arr_tmp[:,j*18+12,:] + arr_tmp[:,j*18+13,:] + arr_tmp[:,j*18+14,:] \
-                            + arr_tmp[:,j*18+15,:] + arr_tmp[:,j*18+16,:] + arr_tmp[:,j*18+17,:]  
-        return arr_out
-
-    # Binning 20 pixels of the 8bit images
-    @jit(nopython=True, fastmath=True, parallel=True, cache=True)
-    def bin20(arr_in):
-        m,n,o   = np.shape(arr_in)
-        arr_tmp = np.empty((m//20,n,o), dtype='uint16')
-        arr_out = np.empty((m//20,n//20,o), dtype='uint32')
-        for i in prange(m//20):
-            arr_tmp[i,:,:] =  arr_in[i*20,:,:]  + arr_in[i*20+1,:,:]  + arr_in[i*20+2,:,:]  + arr_in[i*20+3,:,:]  + arr_in[i*20+4,:,:]  + arr_in[i*20+5,:,:]  + \
-                            arr_in[i*20+6,:,:]  + arr_in[i*20+7,:,:]  + arr_in[i*20+8,:,:]  + arr_in[i*20+9,:,:]  + arr_in[i*20+10,:,:] + arr_in[i*20+11,:,:] + \
-                            arr_in[i*20+12,:,:] + arr_in[i*20+13,:,:] + arr_in[i*20+14,:,:] + arr_in[i*20+15,:,:] + arr_in[i*20+16,:,:] + arr_in[i*20+17,:,:] + \
-                            arr_in[i*20+18,:,:] + arr_in[i*20+19,:,:]
-
-        for j in prange(n//20):
-            arr_out[:,j,:]  = arr_tmp[:,j*20,:]  + arr_tmp[:,j*20+1,:]  + arr_tmp[:,j*20+2,:]  + arr_tmp[:,j*20+3,:]  + arr_tmp[:,j*10+4,:]  + arr_tmp[:,j*20+5,:]  + \
-                            arr_tmp[:,j*20+6,:]  + arr_tmp[:,j*20+7,:]  + arr_tmp[:,j*20+8,:]  + arr_tmp[:,j*20+9,:]  + arr_tmp[:,j*20+10,:] + arr_tmp[:,j*20+11,:] + \
-                            arr_tmp[:,j*20+12,:] + arr_tmp[:,j*20+13,:] + arr_tmp[:,j*10+14,:] + arr_tmp[:,j*20+15,:] + arr_tmp[:,j*20+16,:] + arr_tmp[:,j*20+17,:] + \
-                            arr_tmp[:,j*20+18,:] + arr_tmp[:,j*20+19,:] 
-        return arr_out
+    def binKernel(arr_in, by, bx, out):
+        """Binning by x bx pixels """
+        depth, height, width = arr_in.shape
+        ho = height // by
+        wo = width  // bx
+        for k in prange(depth*ho):                           # channels and output rows in parallel
+            c = k // ho                                      # channel
+            y = k %  ho                                      # output row
+            for x in range(wo):
+                acc = 0
+                for dy in range(by):
+                    yy = y*by + dy
+                    for dx in range(bx):
+                        acc += arr_in[c, yy, x*bx + dx]
+                out[c,y,x] = acc
+
+    @staticmethod
+    def binDtype(bits, by, bx):
+        """Smallest unsigned integer type that holds the sum of by x bx pixels with bits bit depth """
+        largest = (2**bits - 1) * by * bx
+        if   largest <= np.iinfo(np.uint16).max: return np.uint16
+        elif largest <= np.iinfo(np.uint32).max: return np.uint32
+        else:                                    return np.uint64
 
 
 class QDataDisplay(QObject):
@@ -420,82 +1439,345 @@ class QDataDisplay(QObject):
             l=t=0
             return img_r, factor, l, t
 
+class filteredDisplayProcessor():
+    """
+    Filtered Display
+    Mosaic of the displayed channels of the temporally filtered cube with the tiles and
+    labels of the data cube mosaic. Each channel is resized to its tile and scaled to
+    corrected values first, then QDataDisplay.displaytrans enhances small changes and
+    the result is saturated to 8 bit.
+
+      setLayout  tiles and labels from QDataCube._mosaicLayout, displayed channels
+      toImage    8 bit display image
+    """
+
+    def __init__(self):
+
+        self.data   = None                                                          # filtered cube, float32
+        self.scale  = 1.                                                            # corrected value per value in data
+        self.indx   = []                                                            # displayed channels in sorted cube
+        self.layout = None                                                          # mosaic tiles and labels
+        self.small  = None                                                          # channel resized to tile
+        self.trans  = None                                                          # displaytrans of tile
+
+    def setLayout(self, layout, indx):
+        self.layout = layout
+        self.indx   = list(indx)
+
+    def toImage(self, displayImage):
+        """ Filtered channels into their tiles of displayImage """
+        if self.data is None or self.layout is None: return
+        (tw, th) = self.layout["dsize"]
+        if self.small is None or self.small.shape != (th, tw):
+            self.small = np.empty((th, tw), 'float32')
+            self.trans = np.empty((th, tw), 'float32')
+        for i in range(len(self.indx)):
+            if self.indx[i] >= self.data.shape[0]: continue
+            (y, x) = self.layout["tiles"][i]
+            tile = displayImage[y:y+th, x:x+tw]
+            cv2.resize(self.data[self.indx[i]], (tw, th), dst=self.small, interpolation=cv2.INTER_AREA)
+            if self.scale != 1.: self.small *= self.scale                           # filter ran on raw slot
+            QDataDisplay.displaytrans(self.small, out=self.trans)
+            cv2.convertScaleAbs(self.trans, tile)                                   # saturates at 255
+            if i < len(self.layout["labels"]):
+                label = self.layout["labels"][i]
+                tile[:label.shape[0], :label.shape[1]] = label
+
+###############################################################################
+# Channel Math
+# Formula of channels a and b is compiled once per selection into a Numba ufunc,
+# division returns 0 where the denominator is 0.
+###############################################################################
+
+CHANNEL_MATH = {
+    '/'  : 'a / b',
+    '*'  : 'a * b',
+    '-'  : 'a - b',
+    '+'  : 'a + b',
+    'nd' : '(a - b) / (a + b)',                                                     # normalized difference
+}
+
+@jit(nopython=True, fastmath=True, cache=True)
+def _safeDiv(n, d):
+    z = d == 0.
+    return (n / (d + z)) * (not z)                                                  # no division by 0, fastmath evaluates branches eagerly
+
+class _SafeDivision(ast.NodeTransformer):
+    """ Replaces n / d with _safeDiv(n, d) """
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Div):
+            return ast.copy_location(ast.Call(func=ast.Name(id='_safeDiv', ctx=ast.Load()), args=[node.left, node.right], keywords=[]), node)
+        return node
+
+class channelMathProcessor():
+    """
+    Channel Math
+    Evaluates operation between channels a and b of the corrected cube or raw slot,
+    a and b are multiplied by scale to corrected values.
+    operation is one of CHANNEL_MATH or a formula of a and b, e.g. '(a - b) / (a + b)',
+    numpy functions can be used as np.sqrt etc.
+
+      setOperation  select channels and compile formula
+      allocate      result buffers for image size
+      compute       float32 result at cube resolution
+      toImage       8 bit display image, auto scaled or scaled with range
+    """
+
+    _compiled = {}                                                                  # formula: ufunc, compiled once
+
+    def __init__(self, autoscale: bool = True, range: tuple = (0., 1.)):
+
+        self.logger = logging.getLogger("ChMath_")
+
+        self.indx      = []                                                         # channels a and b in sorted cube, empty = off
+        self.formula   = ''
+        self.func      = None                                                       # compiled formula
+        self.autoscale = autoscale                                                  # scale min..max of result to 0..255
+        self.range     = range                                                      # result mapped to 0..255 if not autoscale
+        self.result    = None                                                       # float32 result, allocated per resolution
+        self.image     = None                                                       # 8 bit result, allocated per resolution
+
+    def setOperation(self, indx, operation):
+        """ indx are channels a and b in sorted cube """
+        formula = CHANNEL_MATH.get(operation, operation)
+        try:
+            self.func = channelMathProcessor.compile(formula)
+        except (SyntaxError, ValueError) as e:
+            self.logger.log(logging.ERROR, "Status:Channel math {} not possible: {}!".format(formula, e))
+            self.indx = []
+            return
+        self.indx    = list(indx)
+        self.formula = formula
+        self.logger.log(logging.INFO, "Status:Channel math {} with a={} b={}.".format(formula, *self.indx))
+
+    @staticmethod
+    def compile(formula):
+        """ Numba ufunc of formula of a and b, division by zero gives 0 """
+        if formula in channelMathProcessor._compiled: return channelMathProcessor._compiled[formula]
+        tree = ast.parse(formula, mode='eval')
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and node.id not in ('a', 'b', 'np'):
+                raise ValueError("unknown name {}".format(node.id))
+        tree = ast.fix_missing_locations(_SafeDivision().visit(tree))
+        source = ("def channelMath(a, b, s):\n"
+                  "    a = np.float32(a) * s\n"
+                  "    b = np.float32(b) * s\n"
+                  "    return np.float32({})\n".format(ast.unparse(tree)))
+        namespace = {'np': np, '_safeDiv': _safeDiv}
+        exec(compile(source, '<channel math>', 'exec'), namespace)
+        func = vectorize(['float32(uint8, uint8, float32)', 'float32(uint16, uint16, float32)',
+                          'float32(uint32, uint32, float32)', 'float32(uint64, uint64, float32)'],
+                         nopython=True, fastmath=True)(namespace['channelMath'])
+        channelMathProcessor._compiled[formula] = func
+        return func
+
+    def allocate(self, shape):
+        """ Result and display image for height x width """
+        if self.result is None or self.result.shape != tuple(shape):
+            self.result = np.empty(shape, 'float32')
+            self.image  = np.empty(shape, 'uint8')
+
+    def compute(self, data, scale: float = 1.):
+        """ Evaluate formula on corrected cube data, scale is corrected value per value in data """
+        self.allocate(data.shape[1:])
+        self.func(data[self.indx[0]], data[self.indx[1]], np.float32(scale), out=self.result)
+        return self.result
+
+    def toImage(self, displayImage):
+        """ Scale result to 8 bit and fit it into top left of displayImage """
+        if self.autoscale:
+            cv2.normalize(self.result, self.image, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+        else:
+            (lo, hi) = self.range
+            scale = 255. / (hi - lo) if hi != lo else 0.
+            cv2.convertScaleAbs(np.clip(self.result, lo, hi), self.image, scale, -lo*scale)
+        (height, width) = self.image.shape
+        (newHeight, newWidth) = displayImage.shape[:2]
+        scale = min(newHeight/height, newWidth/width)
+        (tw, th) = (int(width*scale), int(height*scale))
+        cv2.resize(self.image, (tw, th), dst=displayImage[:th, :tw], interpolation=cv2.INTER_LINEAR)
+
+###############################################################################
+# ROI Spectrum
+# Summed area tables of data and data^2 are built once per cube for all channels,
+# mean and standard deviation of any rectangle need 4 table entries per channel,
+# cost does not depend on size or number of ROIs.
+###############################################################################
+
+class roiSpectrumProcessor():
+    """
+    ROI Spectrum
+    rois are (x, y, width, height) in pixels of the unbinned cube, None gives NaN spectrum
+
+      compute   mean and standard deviation spectrum of each roi, background is skipped
+    """
+
+    def __init__(self):
+
+        self.rois = []                                                              # (x, y, width, height)
+        self.S    = None                                                            # summed area table of data
+        self.S2   = None                                                            # summed area table of data^2
+
+    def compute(self, data, binning: tuple = (1,1)):
+        """ rois x 2 x channels array with mean and standard deviation of channels 1.. of data """
+        (depth, height, width) = data.shape
+        if self.S is None or self.S.shape != (depth, height+1, width+1):
+            self.S  = np.zeros((depth, height+1, width+1), 'float64')              # first row and column stay 0
+            self.S2 = np.zeros((depth, height+1, width+1), 'float64')
+        roiSpectrumProcessor.satKernel(data, self.S, self.S2)
+        (by, bx) = binning
+        spectra = np.zeros((len(self.rois), 2, depth-1), 'float32')
+        for i, roi in enumerate(self.rois):
+            if roi is None:
+                spectra[i] = np.nan
+                continue
+            (x, y, w, h) = roi
+            x0 = min(max(int(x)//bx, 0), width-1);  x1 = min(max(int(x+w)//bx, x0+1), width)
+            y0 = min(max(int(y)//by, 0), height-1); y1 = min(max(int(y+h)//by, y0+1), height)
+            n  = (x1-x0) * (y1-y0)
+            s  = self.S[1:,y1,x1]  - self.S[1:,y0,x1]  - self.S[1:,y1,x0]  + self.S[1:,y0,x0]
+            s2 = self.S2[1:,y1,x1] - self.S2[1:,y0,x1] - self.S2[1:,y1,x0] + self.S2[1:,y0,x0]
+            mean = s / n
+            spectra[i,0] = mean
+            spectra[i,1] = np.sqrt(np.maximum(s2/n - mean*mean, 0.))
+        return spectra
+
+    # Summed area tables, one channel per thread
+    @jit(nopython=True, fastmath=True, parallel=True, cache=True)
+    def satKernel(data, S, S2):
+        """S[c,y+1,x+1] sum of data[c,:y+1,:x+1], S2 same for data^2 """
+        depth, height, width = data.shape
+        for c in prange(depth):
+            for y in range(height):
+                row  = 0.
+                row2 = 0.
+                for x in range(width):
+                    v = np.float64(data[c,y,x])
+                    row  += v
+                    row2 += v*v
+                    S[c,y+1,x+1]  = S[c,y,x+1]  + row
+                    S2[c,y+1,x+1] = S2[c,y,x+1] + row2
+
+###############################################################################
+# Temporal Filters
+# Filters run on the corrected cube after binning, their state has the binned
+# resolution. When binning changes, float state is resampled to the new
+# resolution and scaled with the number of summed pixels, so filtering continues
+# without start up transient.
+###############################################################################
+
+def resampleState(state, res: tuple, scale: float = 1.):
+    """ Resample state (..., height, width) to res (..., height, width) and multiply by scale """
+    (height, width) = res[-2:]
+    planes = state.reshape((-1,) + state.shape[-2:])
+    out = np.empty((planes.shape[0], height, width), 'float32')
+    interpolation = cv2.INTER_AREA if height < state.shape[-2] else cv2.INTER_LINEAR
+    for i in range(planes.shape[0]):
+        cv2.resize(planes[i], (width, height), dst=out[i], interpolation=interpolation)
+    out *= scale
+    return out.reshape(state.shape[:-2] + (height, width))
+
+###############################################################################
+# Three Band Equalizer
+# Low band is a 4 pole lowpass at fc_low, high band is the 3 sample delayed
+# signal minus a 4 pole lowpass at fc_high, mid band is the rest.
+# All poles, the history and the output are updated in one fused kernel.
+# https://www.musicdsp.org/en/latest/Filters/236-3-band-equaliser.html
+###############################################################################
+
 class threeBandEqualizerProcessor():
-    """3 Band Equalizer"""
+    """
+    3 Band Equalizer
+    res is the shape of the filtered data, fs the cube rate
+    equalize() accepts uint8, uint16 or binned uint32 data of shape res
+    """
 
-    # Initialize the Processor Thread
+    # Initialize the Processor
     def __init__(self, res: tuple, gain_low: float, gain_mid: float, gain_high: float, fc_low: float, fc_high: float, fs: float):
 
-        self.fs = fs
+        self.res = res
+        self.fs  = fs
         self.fcl = fc_low
         self.fch = fc_high
-     
-             # Gain Controls
+
+        # Gain Controls
         self.lg   = gain_low     # low  gain
         self.mg   = gain_mid     # mid  gain
         self.hg   = gain_high    # high gain
-           
-        # Filter #1 (Low band)   
-        self.f1p0 = np.zeros(res, 'float32')   # Poles ...
-        self.f1p1 = np.zeros(res, 'float32')
-        self.f1p2 = np.zeros(res, 'float32')
-        self.f1p3 = np.zeros(res, 'float32')
-
-        # Filter #2 (High band)
-        self.f2p0 = np.zeros(res, 'float32')   # Poles ...
-        self.f2p1 = np.zeros(res, 'float32')
-        self.f2p2 = np.zeros(res, 'float32')
-        self.f2p3 = np.zeros(res, 'float32')
-
-        # Sample history buffer
-        self.sdm1 = np.zeros(res, 'float32')   # Sample data minus 1
-        self.sdm2 = np.zeros(res, 'float32')   #                   2
-        self.sdm3 = np.zeros(res, 'float32')   #                   3
+
+        # Filter #1 (Low band), poles
+        self.f1p  = np.zeros((4,) + res, 'float32')
+
+        # Filter #2 (High band), poles
+        self.f2p  = np.zeros((4,) + res, 'float32')
+
+        # Sample history buffer, sample data minus 1, 2, 3
+        self.sdm  = np.zeros((3,) + res, 'float32')
 
         self.vsa = 1.0 / 4294967295.0          # Very small amount (Denormal Fix)
 
+        self.out = np.zeros(res, 'float32')    # equalized data, reused
+
+        self.setFrequencies(fc_low, fc_high, fs)
+        self.total_time = 0.                   # time spent equalizing
+        self.count      = 0                    # cubes equalized
+
+    def resample(self, res: tuple, scale: float = 1.):
+        """ Continue filtering at new resolution, scale is ratio of summed pixels new/old """
+        self.f1p = resampleState(self.f1p, res, scale)
+        self.f2p = resampleState(self.f2p, res, scale)
+        self.sdm = resampleState(self.sdm, res, scale)
+        self.out = np.zeros(res, 'float32')
+        self.res = res
+
+    def setGains(self, gain_low: float, gain_mid: float, gain_high: float):
+        self.lg, self.mg, self.hg = gain_low, gain_mid, gain_high
+
+    def setFrequencies(self, fc_low: float, fc_high: float, fs: float):
+        """ Band edges in Hz at cube rate fs """
+        self.fcl, self.fch, self.fs = fc_low, fc_high, fs
         self.lf = 2 * math.sin(math.pi * (self.fcl / self.fs))
         self.hf = 2 * math.sin(math.pi * (self.fch / self.fs))
 
-        self.l = np.zeros(res, 'float32')      # low  frequency sample
-        self.m = np.zeros(res, 'float32')      # mid  frequency sample
-        self.h = np.zeros(res, 'float32')      # high frequency sample
-  
     def equalize(self, data):
-        """ three band equalizer """
-       
-        start_time = time.perf_counter()
-
-        # Filter #1 (lowpass)
-        self.f1p0  += (self.lf * (data      - self.f1p0)) + self.vsa
-        self.f1p1  += (self.lf * (self.f1p0 - self.f1p1))
-        self.f1p2  += (self.lf * (self.f1p1 - self.f1p2))
-        self.f1p3  += (self.lf * (self.f1p2 - self.f1p3))
-        self.l      = self.f1p3
-
-        # Filter #2 (highpass)
-        self.f2p0  += (self.hf * (data      - self.f2p0)) + self.vsa
-        self.f2p1  += (self.hf * (self.f2p0 - self.f2p1))
-        self.f2p2  += (self.hf * (self.f2p1 - self.f2p2))
-        self.f2p3  += (self.hf * (self.f2p2 - self.f2p3))
-        self.h      = self.sdm3 - self.f2p3
-
-        # Calculate midrange (signal - (low + high))
-        self.m      = self.sdm3 - (self.h + self.l)
-        
-        # Scale, combine and return signal
-        self.l     *= self.lg
-        self.m     *= self.mg
-        self.h     *= self.hg
+        """ three band equalizer, returns equalized data (reused buffer) """
 
-        # Shuffle history buffer
-        self.sdm3   = self.sdm2
-        self.sdm2   = self.sdm1
-        self.sdm1   = data
+        start_time = time.perf_counter()
+        threeBandEqualizerProcessor.eqKernel(data.reshape(-1), self.lf, self.hf, self.lg, self.mg, self.hg, self.vsa,
+                                             self.f1p.reshape(4, -1), self.f2p.reshape(4, -1), self.sdm.reshape(3, -1),
+                                             self.out.reshape(-1))
+        self.total_time += time.perf_counter() - start_time
+        self.count      += 1
 
-        total_time += time.perf_counter() - start_time
+        return self.out
 
-        return self.l + self.lm + self.lh
+    # Fused three band equalizer, state is updated in place
+    @jit(nopython=True, fastmath=True, parallel=True, cache=True)
+    def eqKernel(data, lf, hf, lg, mg, hg, vsa, f1p, f2p, sdm, out):
+        """3 band equalizer of flattened data, f1p and f2p are 4 x n poles, sdm is 3 x n history """
+        for i in prange(data.shape[0]):
+            sample = np.float32(data[i])
+            # Filter #1 (lowpass)
+            f1p[0,i] += (lf * (sample   - f1p[0,i])) + vsa
+            f1p[1,i] += (lf * (f1p[0,i] - f1p[1,i]))
+            f1p[2,i] += (lf * (f1p[1,i] - f1p[2,i]))
+            f1p[3,i] += (lf * (f1p[2,i] - f1p[3,i]))
+            l = f1p[3,i]
+            # Filter #2 (highpass)
+            f2p[0,i] += (hf * (sample   - f2p[0,i])) + vsa
+            f2p[1,i] += (hf * (f2p[0,i] - f2p[1,i]))
+            f2p[2,i] += (hf * (f2p[1,i] - f2p[2,i]))
+            f2p[3,i] += (hf * (f2p[2,i] - f2p[3,i]))
+            h = sdm[2,i] - f2p[3,i]
+            # Calculate midrange (signal - (low + high))
+            m = sdm[2,i] - (h + l)
+            # Shuffle history buffer
+            sdm[2,i] = sdm[1,i]
+            sdm[1,i] = sdm[0,i]
+            sdm[0,i] = sample
+            # Scale and combine
+            out[i] = l*lg + m*mg + h*hg
 
 ###############################################################################
 # High Pass Image Processor
@@ -512,37 +1794,55 @@ class threeBandEqualizerProcessor():
 class poormansHighpassProcessor():
     """
     Highpass filter
-    y = (1-alpha) * y + alpha * x
+    y = (1-alpha) * y + alpha * x     averageData, lowpass
+    x - y                             filteredData, highpass
+    uint8, uint16 or binned uint32 data is filtered without conversion,
+    state and output are updated in place.
     """
 
     # Initialize 
-    def __init__(self, res: tuple = (14,720,540), alpha: float = 0.95 ):
+    def __init__(self, res: tuple = (14,540,720), alpha: float = 0.95 ):
 
         # Initialize Processor
+        self.res = res
         self.alpha = alpha
         self.averageData  = np.zeros(res, 'float32')
-        self.filteredData  = np.zeros(res, 'float32')
+        self.filteredData = np.zeros(res, 'float32')
+        self.initialized  = False              # average starts with first data
+        self.total_time   = 0.                 # time spent filtering
+        self.count        = 0                  # cubes filtered
+
+    def resample(self, res: tuple, scale: float = 1.):
+        """ Continue filtering at new resolution, scale is ratio of summed pixels new/old """
+        self.averageData  = resampleState(self.averageData, res, scale)
+        self.filteredData = np.zeros(res, 'float32')
+        self.res = res
 
-    # After Starting the Thread, this runs continously
     def highpass(self, data):
+        """ highpass filtered data (reused buffer) """
         start_time = time.perf_counter()
-        self.averageData  = self.movingavg(data, self.averageData, self.alpha)
-        self.filteredData = self.highpass(data, self.averageData)
-        total_time += time.perf_counter() - start_time
+        if not self.initialized:
+            np.copyto(self.averageData, data, casting='unsafe')
+            self.initialized = True
+        poormansHighpassProcessor.highpassKernel(data.reshape(-1), np.float32(self.alpha),
+                                                 self.averageData.reshape(-1), self.filteredData.reshape(-1))
+        self.total_time += time.perf_counter() - start_time
+        self.count      += 1
         return self.filteredData
 
-    # Numpy Vectorized Image Processor
+    # Moving average and highpass, average is updated in place
     # y = (1-alpha) * y + alpha * x
-    @vectorize(['float32(uint16, float32, float32)'], nopython=True, fastmath=True)
-    def movingavg(data, average, alpha):
-        return np.add(np.multiply(average, 1.-alpha), np.multiply(data, alpha))
-
-    @vectorize(['float32(uint16, float32)'], nopython=True, fastmath=True)
-    def highpass(data, average):
-        return np.subtract(data, average)
-
+    @jit(nopython=True, fastmath=True, parallel=True, cache=True)
+    def highpassKernel(data, alpha, average, out):
+        """Exponential moving average and highpass of flattened data """
+        for i in prange(data.shape[0]):
+            x = np.float32(data[i])
+            average[i] += alpha * (x - average[i])
+            out[i] = x - average[i]
+
+    @staticmethod
     def computeAlpha(f_s = 50.0, f_c = 5.0):
-        w_c = (2.*3.141) * f_c / f_s         # normalized cut off frequency [radians]
+        w_c = (2.*math.pi) * f_c / f_s       # normalized cut off frequency [radians]
         y = 1 - math.cos(w_c);               # compute alpha for 3dB attenuation at cut off frequency
         # y = w_c*w_c / 2.                   # small angle approximation
         return -y + math.sqrt( y*y + 2.*y ); # 
@@ -568,38 +1868,94 @@ class poormansHighpassProcessor():
 ###############################################################################
 # Urs Utzinger 2022
 
-class runningsumHighpassProcessor(Thread):
-    """Highpass filter"""
+class runningsumHighpassProcessor():
+    """
+    Highpass filter
+    Running sum of the last D cubes is kept in an integer accumulator,
+    the delay line is a preallocated D x res circular array with head index.
+    Integer delay line is not resampled, new resolution starts a new filter.
+    One addition and one subtraction per pixel per cube regardless of D.
+    data_lowpass  running sum / D
+    data_highpass data - running sum / D
+    """
 
-    # Initialize the Processor Thread
-    def __init__(self, res: tuple = (14, 720, 540), delay: int = 1 ):
+    # Initialize the Processor
+    def __init__(self, res: tuple = (14, 540, 720), delay: int = 1, dtype = 'uint16'):
 
         # Initialize Processor
-        self.data_lowpass  = np.zeros(res, 'float32')
+        self.res   = res
+        self.delay = delay
+        bits = 8*np.dtype(dtype).itemsize
+        self.delay_line    = np.zeros((delay,) + res, dtype)                     # x(n-D) .. x(n-1)
+        self.head          = 0                                                    # oldest cube in delay line
+        self.accumulator   = np.zeros(res, QDataCube.binDtype(bits, delay, 1))   # y(n), holds sum of D cubes
         self.data_highpass = np.zeros(res, 'float32')
+        self.initialized   = False                                                # delay line starts with first data
+        self.total_time    = 0.                                                   # time spent filtering
+        self.count         = 0                                                    # cubes filtered
 
-        self.circular_buffer = collections.deque(maxlen=delay)
-        # initialize buffer with zeros
-        for i in range(delay):
-            self.circular_buffer.append(self.data_lowpass)
+    def highpass(self, data):
+        """ highpass filtered data (reused buffer) """
+        start_time = time.perf_counter()
+        if not self.initialized:
+            self.delay_line[:] = data
+            np.multiply(data, self.accumulator.dtype.type(self.delay), out=self.accumulator)
+            self.initialized = True
+        runningsumHighpassProcessor.runsumKernel(data.reshape(-1), self.delay_line[self.head].reshape(-1),
+                                                 self.accumulator.reshape(-1), np.float32(1./self.delay),
+                                                 self.data_highpass.reshape(-1))
+        self.head = (self.head + 1) % self.delay
+        self.total_time += time.perf_counter() - start_time
+        self.count      += 1
+        return self.data_highpass
+
+    @property
+    def data_lowpass(self):
+        """ running average of last D cubes """
+        return self.accumulator / self.delay
+
+    # y(n) = ( x(n) - x(n-D) ) + y(n-1), x(n) replaces x(n-D) in delay line
+    @jit(nopython=True, fastmath=True, parallel=True, cache=True)
+    def runsumKernel(data, data_delayed, accumulator, scale, out):
+        """Running sum and highpass of flattened data """
+        for i in prange(data.shape[0]):
+            x = data[i]
+            accumulator[i] = accumulator[i] + x - data_delayed[i]                  # sum includes x(n-D), never negative
+            data_delayed[i] = x
+            out[i] = np.float32(x) - np.float32(accumulator[i]) * scale
+
+    @staticmethod
+    def computeDelay(f_s = 50.0, f_c = 5.0):
+        """ Running sum length with 3dB attenuation of the lowpass at f_c """
+        return max(1, int(round(0.443 * f_s / f_c)))
 
-    @vectorize(['uint8(uint8, uint8, uint8)'], nopython=True, fastmath=True)
-    def runsum(data, data_delayed, data_previous):
-        # Numpy Vectorized Image Processor
-        # y(n) = ( x(n) - x(n-D) ) + y(n-1)
-        # x(n), x(n-D) y(n-1)
-        return np.add(np.subtract(data, data_delayed), data_previous)
+###############################################################################
+# Testing
+###############################################################################
 
-    @vectorize(['uint8(uint8, uint8)'], nopython=True, fastmath=True)
-    def highpass(data, data_filtered):
-        return np.subtract(data, data_filtered)
+if __name__ == '__main__':
+    # Benchmark general purpose binning against the hand unrolled routines
+    # python -m helpers.Processing_helper
+    from archive.Binning_unrolled import bin2, bin3, bin4, bin5, bin6, bin9, bin10, bin12, bin15, bin18, bin20
 
-    def highpass(self, data):
+    unrolled = {2: bin2, 3: bin3, 4: bin4, 5: bin5, 6: bin6, 9: bin9, 10: bin10, 12: bin12, 15: bin15, 18: bin18, 20: bin20}
+    (depth, height, width) = (14, 540, 720)
+    repeats = 50
+
+    cube = np.random.randint(0, 256, (depth, height, width), dtype=np.uint8)
+    cube_hwd = np.ascontiguousarray(cube.transpose(1,2,0))          # unrolled routines bin the first two axes
+
+    print(" bin   unrolled [ms]   binKernel [ms]")
+    for b, binN in unrolled.items():
+        out = np.empty((depth, height//b, width//b), dtype=QDataCube.binDtype(8, b, b))
+        binN(cube_hwd)                                                # compile
+        QDataCube.binKernel(cube, b, b, out)
+        start_time = time.perf_counter()
+        for i in range(repeats):
+            binN(cube_hwd)
+        t_unrolled = (time.perf_counter() - start_time) / repeats
         start_time = time.perf_counter()
-        xn = data                                     # x(n)
-        xnd = self.circular_buffer.popleft()          # x(N-D)
-        self.circular_buffer.append(data)             # put new data into delay line
-        yn1 = self.data_lowpass                       # y(n-1)
-        self.data_lowpass = runsum(xn, xnd, yn1)      # y(n) = x(n) - x(n-D) + y(n-1)
-        self.data_hihgpass = highpass(data, self.data_lowpass)
-        total_time += time.perf_counter() - start_time
+        for i in range(repeats):
+            QDataCube.binKernel(cube, b, b, out)
+        t_kernel = (time.perf_counter() - start_time) / repeats
+        print("{:4d}   {:13.3f}   {:14.3f}".format(b, 1000.*t_unrolled, 1000.*t_kernel))
@@ -26,8 +26,10 @@ from enum import Enum
 # Numerical Tools
 import numpy as np
 # QT
-from PyQt5.QtCore import QObject, QTimer, QThread, pyqtSignal, pyqtSlot, QStandardPaths
-from PyQt5.QtWidgets import QLineEdit, QSlider, QCheckBox, QLabel, QFileDialog, QImage, QGraphicsScene, QPixmap, QGraphicsPixmapItem
+from PyQt5.QtCore import QObject, QTimer, QThread, pyqtSignal, pyqtSlot, QStandardPaths, QRectF, QRect, QPointF
+from PyQt5.QtWidgets import QLineEdit, QSlider, QCheckBox, QLabel, QFileDialog, QGraphicsScene, QGraphicsPixmapItem
+from PyQt5.QtWidgets import QGraphicsView, QGraphicsRectItem, QGraphicsPathItem, QGraphicsSimpleTextItem
+from PyQt5.QtGui import QImage, QPixmap, qRgb, QPainterPath, QPen, QBrush, QColor
 # Supported Cameras
 import PySpin
 import cv2
@@ -36,9 +38,19 @@ from helpers.BlackFly import BlackflyCapture
 from helpers.OpenCV import OpenCVCapture
 # Processing
 from helpers.Processing_helper import QDataCube
+from helpers.Unmixing_helper import CHROMOPHORES
 
 NUM_CHANNELS = 14
 
+# Temporal filter sliders and their line edits
+TEMPORAL_CONTROLS = {
+    "horizontalSlider_LowGain"             : "lineEdit_LowGain",
+    "horizontalSlider_MiddleGain"          : "lineEdit_MidGain",
+    "horizontalSlider_HighGain"            : "lineEdit_HighGain",
+    "horizontalSlider_LowerFrequencyStart" : "lineEdit_LowerFrequencyStart",
+    "horizontalSlider_UpperFrequencyStart" : "lineEdit_UpperFrequencyStart",
+}
+
 class cameraType(Enum):
     opencv   = 0    # supported
     blackfly = 1    # supported
@@ -73,6 +85,13 @@ class QCameraUI(QObject):
         startCameraRequest             # cameraWorker shall start camera
         stopCameraRequest              # cameraWorker shall stop camera
         setDisplayedChannels           # cameraWorker shall set displayed channels
+        setChromophores                # processWorker shall unmix selected chromophores
+        setColorChannels               # processWorker shall display pseudo color composite
+        setChannelMath                 # processWorker shall compute first/second channel operation
+        setROIs                        # processWorker shall compute roi spectra
+        setPhysio                      # processWorker shall compute heart and respiration rate
+        setTemporalFilter              # processWorker shall equalize low, mid and high temporal frequencies
+        setCorrection                  # processWorker shall subtract background and apply flatfield
 
 
     Slots
@@ -89,6 +108,7 @@ class QCameraUI(QObject):
         = Update UI
         on_FPSINReady           # update number on display
         on_FPSOUTReady          # update number on display
+        on_StatsReady           # stage rate and latency as tool tip of output fps
         on_ImageDataReady       # display it        
         on_newCameraListReady   # populate camera list on pull down menu
         on_newImageDataReady    # cameraWorker returns new image data
@@ -108,6 +128,13 @@ class QCameraUI(QObject):
     changeBinningRequest   = pyqtSignal(list) # change binning vet hor
         
     setDisplayedChannelsRequest = pyqtSignal(np.ndarray, list)
+    setChromophoresRequest      = pyqtSignal(list, np.ndarray)   # selected chromophores and measured channels
+    setColorChannelsRequest     = pyqtSignal(list)               # red, green, blue channel in sorted cube
+    setChannelMathRequest       = pyqtSignal(list, str, bool)    # first, second channel in sorted cube, operation, display
+    setROIsRequest              = pyqtSignal(list)               # rois in display image for spectrum
+    setPhysioRequest            = pyqtSignal(np.ndarray, bool)   # measured channels, display pulse map
+    setTemporalFilterRequest    = pyqtSignal(bool, list)         # enable, [gain low, mid, high, fc low, fc high, fs]
+    setCorrectionRequest        = pyqtSignal(bool, bool)         # subtract background, apply flatfield
         
     def __init__(self, parent=None, ui=None):
         # super().__init__()
@@ -126,6 +153,25 @@ class QCameraUI(QObject):
         # create pixmap item and add it to the scene
         self.pixmap = QGraphicsPixmapItem()
         self.scene.addItem(self.pixmap)
+        self.colorTable = [qRgb(i, i, i) for i in range(256)]                              # grayscale lookup table for 8bit images
+
+        # rois are drawn with rubber band on the image, their spectra are plotted in a panel on top of the image
+        self.ui.graphicsView.setDragMode(QGraphicsView.RubberBandDrag)
+        self.rois         = []                                                             # (x, y, width, height) in display image
+        self.roiItems     = []                                                             # roi rectangles in scene
+        self.roiColors    = [QColor(c) for c in ("red", "lime", "cyan", "magenta", "yellow", "orange")]
+        self._rubberBand  = None                                                           # rectangle while dragging
+        self.spectrumPanel = QGraphicsRectItem()                                           # plot area
+        self.spectrumPanel.setBrush(QBrush(QColor(0, 0, 0, 160)))
+        self.spectrumPanel.setPen(QPen(QColor("white")))
+        self.spectrumPanel.setZValue(2)
+        self.spectrumPanel.setVisible(False)
+        self.scene.addItem(self.spectrumPanel)
+        self.spectrumItems = []                                                            # one path per roi
+        self.physioText   = QGraphicsSimpleTextItem()                                      # heart and respiration rate
+        self.physioText.setBrush(QBrush(QColor("white")))
+        self.physioText.setZValue(3)
+        self.scene.addItem(self.physioText)
         
         # add other items to the graphcis scence
         # e.g. text, shape etc...
@@ -167,6 +213,65 @@ class QCameraUI(QObject):
                 DisplayedChannels[channel+1] = False
         return DisplayedChannels
 
+    def _colorChannels(self, MeasuredChannels):
+        """
+        Location in sorted cube of channels selected for red, green and blue
+        Empty if color display is off or a selected channel is not measured
+        """
+        if not self.ui.checkBox_DisplayColor.isChecked(): return []
+        return self._cubeIndex(MeasuredChannels, (self.ui.comboBox_SelectRedChannel, self.ui.comboBox_SelectGreenChannel, self.ui.comboBox_SelectBlueChannel))
+
+    def _mathChannels(self, MeasuredChannels):
+        """ Location in sorted cube of first and second channel of channel math """
+        return self._cubeIndex(MeasuredChannels, (self.ui.comboBox_FirstChannel, self.ui.comboBox_SecondChannel))
+
+    def _cubeIndex(self, MeasuredChannels, comboBoxes):
+        """
+        Location in sorted cube of the channels selected in comboBoxes (item 0 is channel 1)
+        Empty if a selected channel is not measured
+        """
+        indx = []
+        for comboBox in comboBoxes:
+            channel = comboBox.currentIndex() + 1
+            if not MeasuredChannels[channel]:
+                self.logger.log(logging.ERROR, "Status:Channel {} is not measured!".format(channel))
+                return []
+            indx.append(int(np.count_nonzero(MeasuredChannels[:channel])))
+        return indx
+
+    def _binning(self):
+        """ [vertical, horizontal] binning, [1, 1] if binning is off """
+        if not self.ui.checkBox_ApplyBinning.isChecked(): return [1, 1]
+        b = int(self.ui.comboBox_SelectBinning.currentText())
+        return [b, b]
+
+    def _temporalFilter(self):
+        """
+        Three band equalizer settings from sliders
+        Gain sliders are in 1/100, frequency sliders in 1/100 Hz, fs is camera frame rate / measured channels
+        """
+        try:    fps = float(self.ui.lineEdit_CameraFrameRate.text())
+        except ValueError: fps = 0.
+        channels = np.count_nonzero(self._measuredChannels())
+        fs = fps / channels if fps > 0. else 30.
+        fl = self.ui.horizontalSlider_LowerFrequencyStart.value() / 100.
+        fh = self.ui.horizontalSlider_UpperFrequencyStart.value() / 100.
+        return [self.ui.horizontalSlider_LowGain.value()    / 100.,
+                self.ui.horizontalSlider_MiddleGain.value() / 100.,
+                self.ui.horizontalSlider_HighGain.value()   / 100.,
+                min(fl, 0.45*fs), min(max(fh, fl), 0.45*fs), fs]
+
+    def _selectedChromophores(self):
+        """
+        Scan for chromophores selected for unmixing
+        """
+        names = []
+        for name, checkBoxName in CHROMOPHORES.items():
+            checkBox = self.ui.findChild(QCheckBox, checkBoxName)
+            if checkBox is not None and checkBox.isChecked():
+                names.append(name)
+        return names
+
     ########################################################################################
     # Function slots
           
@@ -184,21 +289,140 @@ class QCameraUI(QObject):
         """
         self.ui.lcdNumber_FPSOUT.display("{:5.1f}".format(fps)) 
 
+    @pyqtSlot(dict)
+    def on_StatsReady(self, stats):
+        """
+        Show rate and latency of each stage as tool tip of output frames per second
+        stats is stage: [per second, p50, p95, p99, mean in ms]
+        """
+        lines = ["{:<12s} {:7.1f}/s  {:7.2f} {:7.2f} {:7.2f} ms".format(stage, rate, p50, p95, p99)
+                 for (stage, (rate, p50, p95, p99, mean)) in stats.items()]
+        self.ui.lcdNumber_FPSOUT.setToolTip("<pre>stage        rate        p50     p95     p99\n" + "\n".join(lines) + "</pre>")
+
+    def setColormap(self, colormap = None):
+        """
+        Lookup table for 8bit images, None is grayscale otherwise OpenCV colormap e.g. cv2.COLORMAP_JET
+        """
+        if colormap is None:
+            self.colorTable = [qRgb(i, i, i) for i in range(256)]
+        else:
+            lut = cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(256,1), colormap).reshape(256,3) # BGR
+            self.colorTable = [qRgb(int(r), int(g), int(b)) for (b, g, r) in lut]
+
     @pyqtSlot(np.ndarray)
     def on_ImageDataReady(self, image):
         """
         this will display image in image window
+        image is height x width (8bit, displayed through color table) or height x width x 3 (BGR)
+        QImage wraps the image buffer without copy, it is valid until the display tap delivers the next image.
+        Converting into a pixmap is the only copy per displayed frame, the pixmap item holds the only reference.
         """
-
-        (depth, height, width) = image.shape
-        if depth > 1:  
-            _img = cv2.cvtColor(image, cv2.COLOR_BGR2RGB) # swap B and R color channels
-            _imgQ = QImage(_img.data, width, height, QImage.Format_RGB888) # convert to QImage
+        (height, width) = image.shape[:2]
+        if image.ndim == 3:  
+            _imgQ = QImage(image.data, width, height, image.strides[0], QImage.Format_BGR888) # no B and R swap needed
         else: 
-            _img = image
-            _imgQ = QImage(_img.data, width, height, QImage.Format_Grayscale8) # convert to QImage
-        _pixmap = QPixmap.fromImage(_imgQ)
-        self.pixmap.SetPixmap(_pixmap)        
+            _imgQ = QImage(image.data, width, height, image.strides[0], QImage.Format_Indexed8)
+            _imgQ.setColorTable(self.colorTable)                                           # grayscale or colormap lookup
+        self.pixmap.setPixmap(QPixmap.fromImage(_imgQ))                                    # single copy and allocation per frame
+
+    @pyqtSlot(int)
+    def on_TemporalSliderChanged(self, value):
+        """ Update the line edit box when a temporal filter slider is moved """
+        lineEdit = self.ui.findChild(QLineEdit, TEMPORAL_CONTROLS[self.sender().objectName()])
+        lineEdit.setText(str(float(value)/100.))
+
+    @pyqtSlot()
+    def on_TemporalSliderReleased(self):
+        """ Send temporal filter settings when a slider is released """
+        self.setTemporalFilterRequest.emit(self.ui.checkBox_ApplyTemporalFilter.isChecked(), self._temporalFilter())
+
+    @pyqtSlot()
+    def on_TemporalLineEditChanged(self):
+        """ Manually entered gain or frequency, update slider and send settings """
+        sender = self.sender()
+        try:    value = float(sender.text())
+        except ValueError: return
+        sliderName = [k for (k, v) in TEMPORAL_CONTROLS.items() if v == sender.objectName()][0]
+        self.ui.findChild(QSlider, sliderName).setValue(int(value*100.))
+        self.on_TemporalSliderReleased()
+
+    @pyqtSlot(QRect, QPointF, QPointF)
+    def on_RubberBandChanged(self, viewRect, fromScene, toScene):
+        """
+        Rubber band on image adds a roi when mouse is released
+        """
+        if not viewRect.isNull():
+            self._rubberBand = QRectF(fromScene, toScene).normalized()
+            return
+        if self._rubberBand is None or not self.ui.checkBox_DisplaySpectrum.isChecked(): return
+        rect = self._rubberBand.intersected(self.pixmap.boundingRect())
+        self._rubberBand = None
+        if rect.width() < 1 or rect.height() < 1: return
+        item = QGraphicsRectItem(rect)
+        item.setPen(QPen(self.roiColors[len(self.rois) % len(self.roiColors)], 2))
+        item.setZValue(1)
+        self.scene.addItem(item)
+        self.roiItems.append(item)
+        self.rois.append((rect.x(), rect.y(), rect.width(), rect.height()))
+        self.setROIsRequest.emit(self.rois)
+
+    @pyqtSlot(int)
+    def on_DisplaySpectrumChanged(self, state):
+        """
+        Spectrum display turned off removes rois and plot
+        """
+        if self.ui.checkBox_DisplaySpectrum.isChecked(): return
+        for item in self.roiItems + self.spectrumItems: self.scene.removeItem(item)
+        self.rois, self.roiItems, self.spectrumItems = [], [], []
+        self.spectrumPanel.setVisible(False)
+        self.setROIsRequest.emit(self.rois)
+
+    @pyqtSlot(np.ndarray)
+    def on_SpectrumReady(self, spectra):
+        """
+        Plot mean spectrum with standard deviation bars of each roi 
+        spectra is rois x (mean, std) x channels, plot is in lower right quarter of the image
+        Only paths of a few points are updated, rendering stays in the GUI event loop
+        """
+        bounds = self.pixmap.boundingRect()
+        panel  = QRectF(bounds.x() + bounds.width()/2, bounds.y() + bounds.height()*3/4, bounds.width()/2, bounds.height()/4)
+        self.spectrumPanel.setRect(panel)
+        self.spectrumPanel.setVisible(len(spectra) > 0)
+        while len(self.spectrumItems) < len(spectra):
+            item = QGraphicsPathItem()
+            item.setPen(QPen(self.roiColors[len(self.spectrumItems) % len(self.roiColors)], 2))
+            item.setZValue(3)
+            self.scene.addItem(item)
+            self.spectrumItems.append(item)
+        top = np.nanmax(spectra[:,0] + spectra[:,1]) if np.any(np.isfinite(spectra)) else 0.
+        if not top > 0.: top = 1.
+        channels = spectra.shape[2]
+        dx = panel.width() / max(channels - 1, 1)
+        dy = panel.height() / top
+        for i in range(len(spectra)):
+            path = QPainterPath()
+            for c in range(channels):
+                (mean, std) = spectra[i,:,c]
+                if not np.isfinite(mean): continue
+                (x, y) = (panel.x() + c*dx, panel.bottom() - mean*dy)
+                if path.elementCount() == 0: path.moveTo(x, y)
+                else:                        path.lineTo(x, y)
+                path.moveTo(x, panel.bottom() - min(mean+std, top)*dy)                   # standard deviation bar
+                path.lineTo(x, panel.bottom() - max(mean-std, 0.)*dy)
+                path.moveTo(x, y)
+            self.spectrumItems[i].setPath(path)
+
+    @pyqtSlot(np.ndarray)
+    def on_PhysioReady(self, rates):
+        """
+        Show heart and respiration rate of each roi (whole image if there are no rois)
+        rates is rois x (heart, respiration) per minute, NaN while window is filling
+        """
+        lines = []
+        for i in range(len(rates)):
+            (hr, rr) = ["--" if np.isnan(r) else "{:.0f}".format(r) for r in rates[i]]
+            lines.append("ROI{} HR {} RR {}".format(i+1, hr, rr) if len(self.rois) > 0 else "HR {} RR {}".format(hr, rr))
+        self.physioText.setText("\n".join(lines))
 
     @pyqtSlot(list)
     def on_newCameraListReady(self, cameraDesc):
@@ -269,9 +493,19 @@ class QCameraUI(QObject):
         # do we want bg-subtraction, flatfield correction, 
         # binning, temporal filtering, save to file or 
         # save to ram
+        self.setCorrectionRequest.emit(self.ui.checkBox_SubtractBackground.isChecked(), self.ui.checkBox_ApplyFlatFieldCorrection.isChecked())
+        self.changeBinningRequest.emit(self._binning())
+        self.setTemporalFilterRequest.emit(self.ui.checkBox_ApplyTemporalFilter.isChecked(), self._temporalFilter())
         
         # what to analyze
         # do we want Analysis, Color, Physio, Spectrum?
+        self.setChromophoresRequest.emit(self._selectedChromophores(), mChannels)
+        self.setColorChannelsRequest.emit(self._colorChannels(mChannels))
+        self.setROIsRequest.emit(self.rois if self.ui.checkBox_DisplaySpectrum.isChecked() else [])
+        self.setPhysioRequest.emit(mChannels, self.ui.checkBox_DisplayPhysio.isChecked())
+        if not self.ui.checkBox_DisplayPhysio.isChecked(): self.physioText.setText("")
+        self.setChannelMathRequest.emit(self._mathChannels(mChannels), self.ui.comboBox_MathOperation.currentText(),
+                                        self.ui.checkBox_DisplayAnalysis.isChecked())
         
         # emit signal to camera handler to start acquisition
         self.startCamera.emit()
@@ -304,6 +538,16 @@ class QCameraUI(QObject):
     @pyqtSlot(list)
     def on_BinningChanged(self, bin ):
         self.changeBinningRequest.emit(bin)        
+
+    @pyqtSlot()
+    def on_ChangeBinning(self):
+        """ Binning from combo box if Binning is checked, otherwise 1 """
+        self.changeBinningRequest.emit(self._binning())
+
+    @pyqtSlot()
+    def on_ChangeCorrection(self):
+        """ Background subtraction and flatfield correction check boxes """
+        self.setCorrectionRequest.emit(self.ui.checkBox_SubtractBackground.isChecked(), self.ui.checkBox_ApplyFlatFieldCorrection.isChecked())
         
 class QCamera(QObject):
     """
@@ -311,7 +555,7 @@ class QCamera(QObject):
     Goes to separate thread
     
     Signals
-        imageDataReady
+        dataCubeReady           (datacube, slot) emitted in capture thread
         cameraStatusReady
         cameraFinished
         newCameraListReady
@@ -336,6 +580,7 @@ class QCamera(QObject):
     cameraFinished     = pyqtSignal() 
     newCameraListReady = pyqtSignal(list)                                               # new camera list is available
     fpsReady           = pyqtSignal(float)                                              # fps is available
+    dataCubeReady      = pyqtSignal(object, int)                                        # datacube has complete cube in slot
 
     def __init__(self, parent=None):
         # super().__init__()
@@ -394,8 +639,8 @@ class QCamera(QObject):
     def on_startCamera(self):
         !! need to know datacube depth which is the number of selected measurement channels
         self.camera.startAcquisition(depth=depth, flatfield=None)
-        # self.camera.datacube.dataCubeReady.connect() # needs to go to processing
-        # self.camera.datacube.dataCubeReady.connect() # needs to go to display
+        # hand datacube and slot to processing, connect to processWorker with direct connection
+        self.camera.datacube.dataCubeReady.connect(lambda slot: self.dataCubeReady.emit(self.camera.datacube, slot))
         self.logger.log(logging.DEBUG, "QCamera started")
         self.camera.update() # will run forever unless stop issued
         # This does not stop until camera is stopped
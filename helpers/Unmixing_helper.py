@@ -0,0 +1,259 @@
+############################################################################################
+# Spectral Unmixing Helper
+############################################################################################
+# Chromophore concentration maps from multispectral data cube
+# ------------------------------------------------------------------------------------------
+# Urs Utzinger
+# University of Arizona 2023
+############################################################################################
+
+############################################################################################
+# Modified Beer-Lambert
+# ------------------------------------------------------------------------------------------
+# A(lambda) = -log(R(lambda)) = Sum_j E(lambda, j) * C(j)
+# A  absorbance for each LED channel
+# E  extinction of chromophore j at LED wavelength
+# C  concentration (path length weighted) of chromophore j
+#
+# Least squares solution for all pixels at once
+# C = pinv(E) @ A         (chromophores x channels) @ (channels x pixels)
+#
+# Corrected data is integer, -log(data/reference) and data/reference are
+# looked up in tables indexed by the corrected value (by the mean for binned data)
+#
+# Non negative least squares
+# min |E C - A|^2 with C >= 0, projected coordinate descent per pixel
+# G = E^T E, b = E^T A, C(j) = max(0, C(j) - (G C - b)(j) / G(j,j))
+# warm started from the solution of the previous cube, a few sweeps per pixel suffice
+#
+# https://omlc.org/spectra/
+############################################################################################
+
+import logging
+import math
+import time
+import numpy as np
+from numba import jit, prange
+
+# Unmixing modes
+UNMIX_LSTSQ = 0                                                                     # pseudo inverse, can be negative
+UNMIX_NNLS  = 1                                                                     # non negative, warm started
+
+# Chromophores that can be selected in the Processing tab
+# name: check box in user interface
+CHROMOPHORES = {
+    'HbO2'       : 'checkBox_EnableCalcHbO2',
+    'Hb'         : 'checkBox_EnableCalcHb',
+    'Melanin'    : 'checkBox_EnableCalcMelanin',
+    'Bilirubin'  : 'checkBox_EnableCalcBilirubin',
+    'Fat'        : 'checkBox_EnableCalcFat',
+    'Water'      : 'checkBox_EnableCalcWater',
+    'Scattering' : 'checkBox_EnableCalcScat',
+    'Mie'        : 'checkBox_EnableCalcMie',
+    'Other'      : 'checkBox_EnableCalcOther',
+}
+
+def chromophoreSpectra(names, wavelengths, spectra: dict = {}, mie_power: float = 1.0):
+    """
+    Extinction matrix (wavelengths x chromophores)
+    Tabulated spectra are read from csv files (wavelength [nm], extinction) and interpolated
+    to the LED wavelengths. Scattering is Rayleigh (lambda^-4), Mie is lambda^-mie_power,
+    Other is a constant offset, all normalized to 500nm.
+    Returns extinction matrix and names of the chromophores that could be included.
+    """
+    logger = logging.getLogger("Unmix__")
+    wl = np.asarray(wavelengths, dtype='float64')
+    columns = []
+    included = []
+    for name in names:
+        if name == 'Scattering':
+            columns.append((wl/500.)**-4)
+        elif name == 'Mie':
+            columns.append((wl/500.)**-mie_power)
+        elif name == 'Other':
+            columns.append(np.ones_like(wl))
+        elif name in spectra:
+            try:
+                table = np.loadtxt(spectra[name], delimiter=',', dtype='float64')
+            except OSError:
+                logger.log(logging.ERROR, "Status:Can not read spectrum of {} from {}!".format(name, spectra[name]))
+                continue
+            columns.append(np.interp(wl, table[:,0], table[:,1]))
+        else:
+            logger.log(logging.ERROR, "Status:No spectrum for {}!".format(name))
+            continue
+        included.append(name)
+    if len(columns) == 0:
+        return np.zeros((len(wl), 0)), included
+    return np.stack(columns, axis=1), included
+
+def absorbanceLUT(reference: float = 65280., size: int = 65536):
+    """ -log(value/reference) for integer values 0..size-1, values below 1 are treated as 1 """
+    value = np.maximum(np.arange(size, dtype='float64'), 1.)
+    return (math.log(reference) - np.log(value)).astype('float32')
+
+def reflectanceLUT(reference: float = 65280., size: int = 65536):
+    """ value/reference for integer values 0..size-1 """
+    return (np.arange(size, dtype='float64') / reference).astype('float32')
+
+@jit(nopython=True, fastmath=True, parallel=True, cache=True)
+def lutKernel(data, pixels, lut, out):
+    """
+    Table look up out = lut[data // pixels]
+    pixels is number of binned pixels summed in data, values beyond table are clamped
+    """
+    depth, height, width = data.shape
+    last = lut.shape[0] - 1
+    for y in prange(height):
+        for c in range(depth):
+            for x in range(width):
+                i = data[c,y,x] // pixels
+                out[c,y,x] = lut[i] if i < last else lut[last]
+
+@jit(nopython=True, fastmath=True, parallel=True, cache=True)
+def nnlsKernel(A, Et, G, iterations, C):
+    """
+    Non negative least squares by projected coordinate descent
+    A absorbance (channels, height, width), Et extinction transposed (chromophores, channels)
+    G = Et @ Et.T, C holds the start values and receives the solution
+    """
+    depth, height, width = A.shape
+    k = Et.shape[0]
+    for y in prange(height):
+        b = np.empty(k, dtype=np.float32)
+        x = np.empty(k, dtype=np.float32)
+        for xw in range(width):
+            for j in range(k):
+                acc = np.float32(0.)
+                for c in range(depth):
+                    acc += Et[j,c] * A[c,y,xw]
+                b[j] = acc
+                x[j] = C[j,y,xw]
+            for it in range(iterations):
+                for j in range(k):
+                    grad = -b[j]
+                    for i in range(k):
+                        grad += G[j,i] * x[i]
+                    xj = x[j] - grad / G[j,j]
+                    x[j] = xj if xj > 0. else np.float32(0.)
+            for j in range(k):
+                C[j,y,xw] = x[j]
+
+class spectralUnmixingProcessor():
+    """
+    Spectral Unmixing
+    Pseudo inverse of extinction matrix is computed once per chromophore selection,
+    each cube is unmixed with one matrix multiplication into a preallocated concentration cube.
+    In UNMIX_NNLS mode concentrations are kept non negative, each pixel starts from the
+    solution of the previous cube. unmix_time is the low pass filtered time per cube [ms].
+
+      setChromophores  select chromophores and measured LED channels
+      setMode          UNMIX_LSTSQ or UNMIX_NNLS and number of sweeps
+      absorbance       -log(data/reference) for corrected cube, table look up
+      reflectance      data/reference for corrected cube, table look up
+      unmix            concentration maps (chromophores, height, width)
+    """
+
+    def __init__(self, wavelengths, spectra: dict = {}, mie_power: float = 1.0, reference: float = 65280.,
+                 mode: int = UNMIX_LSTSQ, iterations: int = 3):
+
+        self.logger = logging.getLogger("Unmix__")
+
+        self.wavelengths = np.asarray(wavelengths, dtype='float64')                 # nm of LED channel 1..13
+        self.spectra     = spectra                                                  # csv file for each tabulated chromophore
+        self.mie_power   = mie_power                                                # Mie scattering power
+        self.reference   = reference                                                # corrected value of 100% reflectance
+        self.lut_A       = absorbanceLUT(reference)                                 # -log(value/reference)
+        self.lut_scaled  = {}                                                       # scale: absorbance table of raw values
+        self.lut_R       = reflectanceLUT(reference)                                # value/reference
+        self.mode        = mode                                                     # UNMIX_LSTSQ or UNMIX_NNLS
+        self.iterations  = iterations                                               # NNLS sweeps per cube
+        self.unmix_time  = 0.                                                       # ms per cube, low pass filtered
+
+        self.names       = []                                                       # selected chromophores
+        self.channels    = np.zeros(0, dtype='int64')                               # LED channels in data cube, 1..13
+        self.extinction  = np.zeros((0,0), dtype='float32')                         # channels x chromophores
+        self.pinv        = np.zeros((0,0), dtype='float32')                         # chromophores x channels
+        self.extinctionT = np.zeros((0,0), dtype='float32')                         # chromophores x channels, contiguous
+        self.gram        = np.zeros((0,0), dtype='float32')                         # E^T E for NNLS
+        self.warm        = False                                                    # C holds previous NNLS solution
+        self.A           = None                                                     # absorbance, allocated per resolution
+        self.R           = None                                                     # reflectance, allocated per resolution
+        self.C           = None                                                     # concentrations, allocated per resolution
+
+    def setChromophores(self, names, channels):
+        """
+        Compute pseudo inverse for selected chromophores
+        channels are the LED channels (1..13) in the sorted data cube after the background
+        """
+        self.channels = np.asarray(channels, dtype='int64')
+        if len(self.wavelengths) < np.max(self.channels, initial=0):
+            self.logger.log(logging.ERROR, "Status:LED wavelengths are not configured!")
+            self.names = []
+            return
+        E, self.names = chromophoreSpectra(names, self.wavelengths[self.channels-1], self.spectra, self.mie_power)
+        self.extinction = E.astype('float32')
+        self.pinv       = np.linalg.pinv(E).astype('float32')                       # least squares solution
+        self.extinctionT = np.ascontiguousarray(self.extinction.T)
+        self.gram       = (E.T @ E).astype('float32')
+        if np.any(np.diag(self.gram) <= 0.):
+            self.logger.log(logging.ERROR, "Status:Chromophore without absorption, NNLS not possible!")
+            self.mode = UNMIX_LSTSQ
+        self.C          = None                                                      # new number of chromophores
+        self.logger.log(logging.INFO, "Status:Unmixing {} with {} channels.".format(self.names, len(self.channels)))
+
+    def setMode(self, mode: int = UNMIX_LSTSQ, iterations: int = 3):
+        """ Least squares or non negative least squares with iterations sweeps per cube """
+        self.mode       = mode
+        self.iterations = iterations
+        self.warm       = False
+
+    def _allocate(self, shape):
+        (depth, height, width) = shape
+        if self.A is None or self.A.shape != (len(self.channels), height, width):
+            self.A = np.empty((len(self.channels), height, width), dtype='float32')
+        if self.C is None or self.C.shape != (len(self.names), height, width):
+            self.C = np.empty((len(self.names), height, width), dtype='float32')
+            self.warm = False
+
+    def absorbance(self, data, pixels: int = 1, scale: float = 1.):
+        """
+        -log(data/reference) of corrected cube, background at index 0 is skipped
+        data below 1 is treated as 1, pixels is by x bx for binned data
+        scale is corrected value per value in data, e.g. for the raw slot
+        """
+        self._allocate(data.shape)
+        if scale == 1.:
+            lut = self.lut_A
+        else:
+            if scale not in self.lut_scaled:
+                self.lut_scaled[scale] = absorbanceLUT(self.reference/scale, int(65536/scale))
+            lut = self.lut_scaled[scale]
+        lutKernel(data[1:1+len(self.channels)], pixels, lut, self.A)
+        return self.A
+
+    def reflectance(self, data, pixels: int = 1):
+        """ data/reference of corrected cube, background at index 0 is skipped """
+        (depth, height, width) = data.shape
+        if self.R is None or self.R.shape != (depth-1, height, width):
+            self.R = np.empty((depth-1, height, width), dtype='float32')
+        lutKernel(data[1:], pixels, self.lut_R, self.R)
+        return self.R
+
+    def unmix(self, absorbance):
+        """
+        Concentration maps
+        UNMIX_LSTSQ one matrix multiplication for all pixels
+        UNMIX_NNLS  projected coordinate descent, first cube starts from clipped least squares
+        """
+        start_time = time.perf_counter()
+        (depth, height, width) = absorbance.shape
+        self._allocate((depth+1, height, width))
+        if self.mode != UNMIX_NNLS or not self.warm:
+            np.matmul(self.pinv, absorbance.reshape(depth, height*width), out=self.C.reshape(len(self.names), height*width))
+        if self.mode == UNMIX_NNLS:
+            if not self.warm: np.maximum(self.C, 0., out=self.C)
+            nnlsKernel(absorbance, self.extinctionT, self.gram, self.iterations, self.C)
+            self.warm = True
+        self.unmix_time = 0.9*self.unmix_time + 0.1*(time.perf_counter() - start_time)*1000.
+        return self.C
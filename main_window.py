@@ -31,9 +31,14 @@ import numpy as np
 # Custom imports
 from helpers.Qserial_helper      import QSerial, QSerialUI
 from helpers.Qlightsource_helper import QLightSource
-from helpers.Qcamera_helper      import QCamera, QCameraUI, cameraType
+from helpers.Qcamera_helper      import QCamera, QCameraUI, cameraType, TEMPORAL_CONTROLS
 # from helpers.Qdisplay_helper     import QDisplay, QDisplayUI
-# from Processing_helper           import QDataCube
+from helpers.Processing_helper   import QProcessWorker, QDisplayTap, QUEUE_DROP_OLDEST
+from helpers.Unmixing_helper     import spectralUnmixingProcessor
+from helpers.Physio_helper       import physioProcessor
+from configs.blackfly_configs    import configs as bf_configs
+from configs.unmixing_configs    import configs as um_configs
+from configs.physio_configs      import configs as ph_configs
 
 # QT
 # Deal with high resolution displays
@@ -222,13 +227,6 @@ class mainWindow(QMainWindow):
         self.cameraWorker.fpsReady.connect(         self.cameraUI.on_FPSINReady )
         self.cameraWorker.newCameraListReady.connect(self.cameraUI.on_newCameraListReady  ) #
         
-        # Signals from Camera to processWorker
-        self.cameraWorker.imageDataReady.connect(   self.processWorker.on_imageDataReady )
-
-        # Signals from Processor to Camera-UI
-        # self.processWorker.fpsReady.connect(          self.cameraUI.on_FPSOUTReady )
-        # self.processWorker.newImageDataReady.connect( self.cameraUI.on_newImageDataReady )
-
         # Signals from Camera-UI to Camera
         self.cameraUI.changeCameraRequest.connect( self.cameraWorker.on_changeCamera )     # cameraWorker shall change camera
         self.cameraUI.changeExposureRequest.connect( self.cameraWorker.on_changeExposure)  # cameraWorker shall change exposure
@@ -249,6 +247,9 @@ class mainWindow(QMainWindow):
         self.ui.comboBoxDropDown_Cameras.currentIndexChanged.connect( self.cameraUI.on_ChangeCamera) # connect changing camera
         # User selected binning, entered exposure time, frame rate
         self.ui.comboBox_SelectBinning.currentIndexChanged.connect( self.cameraUI.on_ChangeBinning)  # connect changing binning
+        self.ui.checkBox_ApplyBinning.stateChanged.connect( self.cameraUI.on_ChangeBinning)         # binning on or off
+        self.ui.checkBox_SubtractBackground.stateChanged.connect( self.cameraUI.on_ChangeCorrection)
+        self.ui.checkBox_ApplyFlatFieldCorrection.stateChanged.connect( self.cameraUI.on_ChangeCorrection)
         self.ui.lineEdit_CameraFrameRate.returnPressed.connect( self.cameraUI.on_FrameRateChanged )
         self.ui.lineEdit_CameraExposureTime.returnPressed.connect( self.cameraUI.on_ExposureTimeChanged )
 
@@ -263,10 +264,78 @@ class mainWindow(QMainWindow):
         # Processors
         #----------------------------------------------------------------------------------------------------------------------
         
-        # Camera capture thread
+        # Processing thread
         self.processThread = QThread()                                                      # create QThread object
         self.processThread.start()                                                          # start thread which will start worker
 
+        # Create processing worker, bounded queue of data cubes
+        # processes > 0 uses worker processes, requires 'cubeshared' in camera configs
+        self.processWorker = QProcessWorker(maxsize=2, policy=QUEUE_DROP_OLDEST, processes=0, temporal_filter=bf_configs['temporalfilter'])
+
+        # Signals from Camera to processWorker
+        # direct connection: queue policy is applied in capture thread, QUEUE_BLOCK can hold back capture
+        self.cameraWorker.dataCubeReady.connect(   self.processWorker.on_dataCubeReady, QtCore.Qt.DirectConnection )
+        self.cameraUI.startCameraRequest.connect(  self.processWorker.on_start )
+        self.cameraUI.stopCameraRequest.connect(   self.processWorker.on_stop, QtCore.Qt.DirectConnection )    # unblock capture before camera stops
+        self.cameraUI.changeBinningRequest.connect(self.processWorker.on_changeBinning )
+        self.cameraUI.setCorrectionRequest.connect(self.processWorker.on_setCorrection )
+
+        # Display tap, stays in GUI thread, camera and processing run at full rate, display at 'displayfps'
+        self.displayTap = QDisplayTap(displayfps=bf_configs['displayfps'])
+        self.processWorker.displayTap = self.displayTap
+        self.displayTap.stats = self.processWorker.stats                                   # delivery and render time in GUI thread
+        self.cameraUI.setDisplayedChannelsRequest.connect(self.processWorker.on_setDisplayedChannels)
+
+        # Pseudo color display
+        self.processWorker.setColorLUT(gain=bf_configs['colorgain'], offset=bf_configs['coloroffset'], gamma=bf_configs['colorgamma'])
+        self.cameraUI.setColorChannelsRequest.connect(self.processWorker.on_setColorChannels)
+
+        # Channel math
+        self.cameraUI.setChannelMathRequest.connect(self.processWorker.on_setChannelMath)
+
+        # Temporal filter, gains 0..2 and band edges 0..10 Hz in 1/100
+        for (name, maximum, value) in (("LowGain", 200, 100), ("MiddleGain", 200, 100), ("HighGain", 200, 100),
+                                       ("LowerFrequencyStart", 1000, 50), ("UpperFrequencyStart", 1000, 300)):
+            horizontalSlider = self.ui.findChild(QSlider, "horizontalSlider_"+name)
+            horizontalSlider.setMinimum(0)
+            horizontalSlider.setMaximum(maximum)
+            horizontalSlider.valueChanged.connect( self.cameraUI.on_TemporalSliderChanged )
+            horizontalSlider.sliderReleased.connect( self.cameraUI.on_TemporalSliderReleased )
+            horizontalSlider.setValue(value)
+        for name in TEMPORAL_CONTROLS.values():
+            lineEdit = self.ui.findChild(QLineEdit, name)
+            lineEdit.returnPressed.connect( self.cameraUI.on_TemporalLineEditChanged )
+        self.ui.checkBox_ApplyTemporalFilter.stateChanged.connect( self.cameraUI.on_TemporalSliderReleased )
+        self.cameraUI.setTemporalFilterRequest.connect(self.processWorker.on_setTemporalFilter)
+
+        # ROI spectrum
+        self.ui.graphicsView.rubberBandChanged.connect(self.cameraUI.on_RubberBandChanged)
+        self.ui.checkBox_DisplaySpectrum.stateChanged.connect(self.cameraUI.on_DisplaySpectrumChanged)
+        self.cameraUI.setROIsRequest.connect(self.processWorker.on_setROIs)
+        self.processWorker.spectrumReady.connect(self.cameraUI.on_SpectrumReady)
+
+        # Physio
+        self.processWorker.physio = physioProcessor(fs=ph_configs['fs'], window=ph_configs['window'], heart=ph_configs['heart'],
+                                                    respiration=ph_configs['respiration'], binning=ph_configs['binning'],
+                                                    channel=ph_configs['channel'])
+        self.cameraUI.setPhysioRequest.connect(self.processWorker.on_setPhysio)
+        self.processWorker.physioReady.connect(self.cameraUI.on_PhysioReady)
+
+        # Spectral unmixing of selected chromophores
+        self.processWorker.unmixer = spectralUnmixingProcessor(wavelengths=um_configs['wavelengths'], spectra=um_configs['spectra'],
+                                                               mie_power=um_configs['mie_power'], reference=um_configs['reference'],
+                                                               mode=um_configs['mode'], iterations=um_configs['iterations'])
+        self.cameraUI.setChromophoresRequest.connect(self.processWorker.on_setChromophores)
+
+        # Signals from Processor to Camera-UI
+        self.processWorker.fpsReady.connect(          self.cameraUI.on_FPSOutReady )
+        self.processWorker.statsReady.connect(        self.cameraUI.on_StatsReady )
+        self.displayTap.imageDataReady.connect(       self.cameraUI.on_ImageDataReady )
+
+        self.processWorker.moveToThread(self.processThread)                                     # move worker to thread
+
+        self.logger.log(logging.INFO, "[{}]: processing initialized.".format(int(QThread.currentThreadId())))
+
         # Flatfield
         # flatfield = np.zeros((depth, height, width), dtype=np.uint16)
         